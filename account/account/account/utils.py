@@ -3,13 +3,218 @@ import MySQLdb
 from loguru import logger
 import os
 import re
+import threading
+import time
 
 logger.add("logs/default.log")
 
 
+class MySQLPool:
+    """Process-wide pool of persistent MySQL connections
+
+    One pool exists per (host, username, dbname) in each process, shared by all
+    threads. Connections are pinged on checkout, reaped when idle longer than
+    max_idle (keeping at least min_size), and forgotten after fork so that Celery
+    prefork children never share a socket with their parent.
+    """
+
+    _pools = dict()
+    _pools_lock = threading.Lock()
+
+    def __init__(
+            self,
+            host,
+            username,
+            password,
+            dbname,
+            min_size=int(os.environ.get("SQL_POOL_MIN_SIZE", "1")),
+            max_size=int(os.environ.get("SQL_POOL_MAX_SIZE", "10")),
+            max_idle=float(os.environ.get("SQL_POOL_MAX_IDLE", "300")),
+            timeout=float(os.environ.get("SQL_POOL_TIMEOUT", "5"))
+    ):
+        """
+
+        Args:
+            host (str): database host
+            username (str): database user
+            password (str): database password
+            dbname (str): database name
+            min_size (int, optional): connections kept when reaping. Defaults to SQL_POOL_MIN_SIZE or 1.
+            max_size (int, optional): maximum open connections. Defaults to SQL_POOL_MAX_SIZE or 10.
+            max_idle (float, optional): seconds before an idle connection is reaped. Defaults to
+                SQL_POOL_MAX_IDLE or 300.
+            timeout (float, optional): seconds to wait for a free connection. Defaults to
+                SQL_POOL_TIMEOUT or 5.
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.dbname = dbname
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        """Forget all connections, used on creation and in a forked child
+        """
+        # connections inherited from parent are kept referenced but never used,
+        # deallocating them would send COM_QUIT on the socket shared with parent
+        self._inherited = [conn for conn, _ in getattr(self, "_idle", [])]
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        # idle connections as (conn, released_at), most recently used at the end
+        self._idle = []
+        # number of connections checked out or idle
+        self._size = 0
+
+    @classmethod
+    def get(cls, host, username, password, dbname):
+        """Return the pool of current process for given database, create if not existing
+
+        Returns:
+            MySQLPool: pool
+        """
+        key = (host, username, dbname)
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls(host, username, password, dbname)
+                cls._pools[key] = pool
+        return pool
+
+    @classmethod
+    def _after_fork(cls):
+        """Reset locks and pools in a forked child, a lock held by another thread
+        at fork time would otherwise never be released
+        """
+        cls._pools_lock = threading.Lock()
+        for pool in cls._pools.values():
+            pool._reset()
+
+    def _check_fork(self):
+        """Drop connections inherited from parent process without closing them,
+        in case the process was not forked by os.fork
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _connect(self):
+        return MySQLdb.connect(
+            host=self.host,
+            user=self.username,
+            passwd=self.password,
+            db=self.dbname
+        )
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _reap(self, now):
+        """Close connections idle longer than max_idle, keeping at least min_size,
+        called with self._cond held
+        """
+        while self._idle and self._size > self.min_size:
+            conn, released_at = self._idle[0]
+            if now - released_at <= self.max_idle:
+                break
+            self._idle.pop(0)
+            self._size -= 1
+            self._close(conn)
+
+    def acquire(self):
+        """Check out a healthy connection, open a new one if none is idle and
+        max_size is not reached, otherwise wait at most timeout seconds
+
+        Returns:
+            MySQLdb.connections.Connection: connection
+        """
+        self._check_fork()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                self._reap(time.monotonic())
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"{type(self).__name__} : No connection available.")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                # reserve a slot before connecting outside the lock
+                else:
+                    self._size += 1
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._discard()
+                    raise
+            # health check on checkout
+            try:
+                conn.ping()
+            except Exception:
+                logger.debug(f"{type(self).__name__} : Stale connection dropped.")
+                self._close(conn)
+                self._discard()
+            else:
+                return conn
+
+    def release(self, conn, broken=False):
+        """Return connection to pool, close it if broken
+
+        Any open transaction is rolled back so that the next user does not read
+        from a stale snapshot.
+
+        Args:
+            conn (MySQLdb.connections.Connection): connection
+            broken (bool, optional): connection should not be reused. Defaults to False.
+        """
+        if self._pid != os.getpid():
+            return
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            self._close(conn)
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self):
+        """Free the slot of a connection that is closed or never opened
+        """
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def close(self):
+        """Close all idle connections
+        """
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close(conn)
+
+
+os.register_at_fork(after_in_child=MySQLPool._after_fork)
+
+
 class MySQLHandle:
     """MySQLHandle as context management
     Always check if self.conn is None (connection error, report internal error)
+    Connections are borrowed from the process-wide MySQLPool and returned on exit.
     """
 
     def __init__(
@@ -24,15 +229,12 @@ class MySQLHandle:
         self.password = password
         self.dbname = dbname
         self.conn = None
+        self._pool = MySQLPool.get(host, username, password, dbname)
+        self._broken = False
 
     def __enter__(self):
         try:
-            self.conn = MySQLdb.connect(
-                host=self.host,
-                user=self.username,
-                passwd=self.password,
-                db=self.dbname
-            )
+            self.conn = self._pool.acquire()
         except Exception:
             logger.exception(f"{type(self).__name__} : Connection to database failed.")
             # avoid ide warning, Exception will not be raised due to return in finally
@@ -67,6 +269,7 @@ class MySQLHandle:
                 result = cur.fetchall()
         except Exception:
             logger.exception(f"{type(self).__name__} : {query}")
+            self._broken = True
             # avoid ide warning, Exception will not be raised due to return in finally
             raise
         finally:
@@ -76,7 +279,8 @@ class MySQLHandle:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.conn:
-            self.conn.close()
+            self._pool.release(self.conn, broken=self._broken or exc_type is not None)
+            self.conn = None
 
 
 class ValueConverter:
@@ -0,0 +1,37 @@
+"""Gunicorn config for production serving
+
+Run with: gunicorn -c gunicorn.conf.py account.wsgi:application
+Reload code and workers gracefully with: kill -HUP <master pid>
+All settings can be overridden with GUNICORN_* environment variables, see
+"Serving" in README.md for tuning.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# Views are synchronous and mostly CPU bound (captcha, password hashing) or
+# short MySQL queries, so processes scale with cores and a few threads cover
+# database waits.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", "2"))
+
+# Recycle workers after max_requests +- jitter requests to bound memory growth,
+# jitter avoids all workers restarting at the same time.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+# time for in-flight requests to finish on reload, recycling or shutdown
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+# nginx keeps upstream connections alive
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Workers import the app after fork, so HUP reloads code and no MySQL
+# connection is shared across processes.
+preload_app = False
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG", "-")
+loglevel = os.environ.get("GUNICORN_LOGLEVEL", "info")
@@ -0,0 +1,90 @@
+"""Closed-loop benchmark of /shopping/api/list_inventory/
+
+Each of --concurrency clients sends its next request as soon as the previous
+one returns, for --duration seconds after --warmup seconds. Prints throughput,
+latency percentiles and errors. Requires httpx and PyJWT.
+
+Example, with a user who tracks products and has stores mapped around zipcode:
+    python docs/benchmark.py --host http://127.0.0.1:8000 --secret-key <SECRET_KEY> \\
+        --userid 12345678 --zipcode 12011 --concurrency 32 --duration 60
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+import jwt
+
+
+async def login(client, args):
+    # same token as issued by account, the session keeps it afterwards
+    token = jwt.encode({"userid": args.userid, "authenticated": True}, args.secret_key, algorithm="HS256")
+    await client.get(f"/shopping/{token}/")
+    # the page sets the csrftoken cookie
+    await client.get("/shopping/")
+    return client.cookies.get("csrftoken")
+
+
+async def run_client(client, csrftoken, args, start, stop, latencies, errors):
+    body = json.dumps({"zipcode": args.zipcode, "mode": args.mode})
+    headers = {"Content-Type": "application/json", "X-CSRFToken": csrftoken}
+    while True:
+        begin = time.monotonic()
+        if begin >= stop:
+            return
+        try:
+            rsp = await client.post("/shopping/api/list_inventory/", content=body, headers=headers)
+            ok = rsp.status_code == 200 and not rsp.json().get("message")
+        except Exception:
+            ok = False
+        end = time.monotonic()
+        if begin >= start:
+            if ok:
+                latencies.append(end - begin)
+            else:
+                errors.append(end - begin)
+
+
+async def main(args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    clients = [
+        httpx.AsyncClient(base_url=args.host, timeout=args.timeout, limits=limits)
+        for _ in range(args.concurrency)
+    ]
+    csrftokens = await asyncio.gather(*(login(client, args) for client in clients))
+    start = time.monotonic() + args.warmup
+    stop = start + args.duration
+    latencies, errors = [], []
+    await asyncio.gather(*(
+        run_client(client, csrftoken, args, start, stop, latencies, errors)
+        for client, csrftoken in zip(clients, csrftokens)
+    ))
+    for client in clients:
+        await client.aclose()
+
+    print(f"concurrency  {args.concurrency}")
+    print(f"requests     {len(latencies)}")
+    print(f"errors       {len(errors)}")
+    print(f"throughput   {len(latencies) / args.duration:.1f} req/s")
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100)
+        print(f"latency p50  {cuts[49] * 1000:.1f} ms")
+        print(f"latency p95  {cuts[94] * 1000:.1f} ms")
+        print(f"latency p99  {cuts[98] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="http://127.0.0.1:8000")
+    parser.add_argument("--secret-key", required=True, help="SECRET_KEY of shopping")
+    parser.add_argument("--userid", type=int, required=True)
+    parser.add_argument("--zipcode", default="12011")
+    parser.add_argument("--mode", default="swr", help="swr or empty to wait for quantity")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--warmup", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=30)
+    asyncio.run(main(parser.parse_args()))
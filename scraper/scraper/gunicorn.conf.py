@@ -0,0 +1,44 @@
+"""Gunicorn config for production serving
+
+Run with: gunicorn -c gunicorn.conf.py scraper.asgi:application
+Reload code and workers gracefully with: kill -HUP <master pid>
+All settings can be overridden with GUNICORN_* environment variables, see
+"Serving" in README.md for tuning.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# Async views wait for retailer responses on the event loop, so one uvicorn
+# worker per core is enough to hold hundreds of in-flight requests.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "uvicorn.workers.UvicornWorker")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+# only used by the gthread worker class
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+
+# Recycle workers after max_requests +- jitter requests to bound memory growth,
+# jitter avoids all workers restarting at the same time.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+# upstream downloads wait at most UPSTREAM_TOKEN_WAIT, then 3s x 3 retries
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+# time for in-flight requests to finish on reload, recycling or shutdown
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+# shopping keeps connections to the scraper alive
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Workers import the app after fork, so HUP reloads code and no Redis or HTTP
+# connection is shared across processes.
+preload_app = False
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG", "-")
+loglevel = os.environ.get("GUNICORN_LOGLEVEL", "info")
+
+
+def post_worker_init(worker):
+    # rebuild in-process filter of invalid SKUs before serving requests
+    from worker.scraper import ScraperTarget
+    ScraperTarget._invalid_skus.load()
@@ -134,3 +134,11 @@ STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Batch quantity lookup.
+# Maximum SKUs per request, concurrent upstream downloads per
+# request and seconds per download, which is reported as
+# failed after that.
+QUANTITY_BATCH_MAX_SKUS = int(os.environ.get("QUANTITY_BATCH_MAX_SKUS", "50"))
+QUANTITY_BATCH_WORKERS = int(os.environ.get("QUANTITY_BATCH_WORKERS", "8"))
+QUANTITY_BATCH_DEADLINE = float(os.environ.get("QUANTITY_BATCH_DEADLINE", "10"))
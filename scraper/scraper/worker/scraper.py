@@ -1,63 +1,58 @@
 """A Simple Web Scraper Module"""
 
-from worker.utils import IntConverter, StrAlnumSpaceConverter
+from worker.utils import AdaptiveLimit, BloomSet, CircuitBreaker, IntConverter, ResponseCache, StrAlnumSpaceConverter, TokenBucket
+from asgiref.sync import async_to_sync
 from loguru import logger
-import requests
-from urllib3 import Retry
+import asyncio
+import httpx
+import os
+from urllib.parse import urlsplit
+import weakref
 
 logger.add("logs/default.log")
 
 
-class AutoAdapter(requests.adapters.HTTPAdapter):
-    """HTTPAdapter with timeout and auto retry"""
-    
-    def __init__(self, *args, **kwargs):
-        """Set timeout as 3 seconds and try at most 3 times unless overwritten
-        """
-        
-        # default timeout: 3 seconds
-        self._timeout = 3
-        # default retry: 3 times
-        self._retry = Retry(
-            total=3,
-            status_forcelist=[413, 429, 500, 502, 503, 504],
-            backoff_factor=0.5
-        )
+class ScraperBase:
+    """Scraper base class
 
-        # HTTPAdapter does not use "timeout" as argument
-        # delete to avoid repeated argument when overwriting default timeout
-        if "timeout" in kwargs:
-            self._timeout = kwargs["timeout"]
-            del kwargs["timeout"]
-        
-        # HTTPAdapter uses "max_retries" as argument
-        # set to default retry if not assigned
-        if kwargs.get("max_retries") is None:
-            kwargs["max_retries"] = self._retry
-
-        super().__init__(*args, **kwargs)
-    
-    def send(self, request, **kwargs):
-        """Send request with timeout
+    Downloads go through one pooled httpx.AsyncClient per event loop, with at
+    most HTTP_POOL_MAXSIZE connections, a timeout and retries of server errors.
+    Sync methods are thin wrappers of the async ones for scripts, each call
+    running in an event loop of its own.
 
-        Args:
-            request (type): request object
+    Downloads of an endpoint go through its CircuitBreaker and AdaptiveLimit.
+    Throttled calls, i.e. 413, 429 and 503, are not retried but reported to
+    both, so that a throttling retailer sees fewer calls, and none while the
+    circuit is open, instead of every worker retrying. Callers then get the
+    cached or stale answer if any, or fail fast.
+    """
 
-        Returns:
-            type: response object
-        """
-        timeout = kwargs.get("timeout")
-        if timeout is None:
-            kwargs["timeout"] = self._timeout
-        return super().send(request, **kwargs)
+    _clients = weakref.WeakKeyDictionary()
 
+    # throttled calls are not retried
+    _timeout = 3
+    _retries = 3
+    _backoff_factor = 0.5
+    _status_forcelist = (500, 502, 504)
+    _throttled = (413, 429, 503)
+
+    # retailer of upstream hosts, set in subclasses to pace requests with
+    # token buckets per retailer and host shared by all scraper processes
+    _retailer = None
+    _buckets = dict()
+    # (CircuitBreaker, AdaptiveLimit) per retailer and endpoint
+    _guards = dict()
+
+    # parsed responses shared by all scrapers of the process and, through
+    # Redis, of all processes. Endpoints without TTL are not cached.
+    _cache = ResponseCache(int(os.environ.get("SCRAPER_CACHE_MAX_BYTES", str(16 * 1024 * 1024))))
+    _cache_ttl = dict()
+    # cached info is kept as long to answer while upstream fails
+    _stale_ttl = int(os.environ.get("SCRAPER_STALE_TTL", str(30 * 86400)))
+    # empty results confirmed by upstream, e.g. unknown keyword or no stock
+    # nearby, are cached as long, failed downloads never
+    _negative_ttl = dict()
 
-class ScraperBase:
-    """Scraper base class"""
-    
-    # change with AutoAdapter(timeout=3, max_retries=3) if needed
-    _adapter = AutoAdapter()
-    
     def __init__(self, url=None):
         """
 
@@ -66,40 +61,290 @@ class ScraperBase:
         """
         self._url = url
         self._response = None
+        # set by parsers when upstream answered with no result
+        self.empty = False
+        # set when info is a stale copy since upstream could not answer
+        self.stale = False
+        # set when skipped since upstream recently did not know the item
+        self.invalid = False
+
+    @classmethod
+    def _client(cls):
+        """Return async client of running event loop, create if not existing
+
+        Returns:
+            httpx.AsyncClient: client
+        """
+        loop = asyncio.get_running_loop()
+        client = cls._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=cls._timeout,
+                limits=httpx.Limits(
+                    max_connections=int(os.environ.get("HTTP_POOL_MAXSIZE", "10")),
+                    max_keepalive_connections=int(os.environ.get("HTTP_POOL_MAXSIZE", "10"))
+                )
+            )
+            cls._clients[loop] = client
+        return client
+
+    @classmethod
+    def _bucket(cls, url):
+        """Return token bucket of retailer and host of url
+
+        Returns:
+            TokenBucket: bucket
+        """
+        key = f"{cls._retailer}:{urlsplit(url).hostname}"
+        bucket = cls._buckets.get(key)
+        if bucket is None:
+            bucket = cls._buckets.setdefault(key, TokenBucket(
+                key,
+                float(os.environ.get("UPSTREAM_RATE", "5")),
+                int(os.environ.get("UPSTREAM_BURST", "10"))
+            ))
+        return bucket
+
+    @classmethod
+    def _guard(cls, endpoint):
+        """Return circuit breaker and concurrency limit of retailer and endpoint
+
+        Returns:
+            tuple: (CircuitBreaker, AdaptiveLimit)
+        """
+        key = f"{cls._retailer}.{endpoint}"
+        guard = cls._guards.get(key)
+        if guard is None:
+            maximum = int(os.environ.get("HTTP_POOL_MAXSIZE", "10"))
+            guard = cls._guards.setdefault(key, (
+                CircuitBreaker(
+                    key,
+                    int(os.environ.get("UPSTREAM_CIRCUIT_FAILURES", "5")),
+                    float(os.environ.get("UPSTREAM_CIRCUIT_RESET", "30"))
+                ),
+                AdaptiveLimit(key, maximum // 2, 1, maximum)
+            ))
+        return guard
+
+    @classmethod
+    def guard_stats(cls):
+        """
+
+        Returns:
+            dict: retailer.endpoint -> circuit state and concurrency limit of this process
+        """
+        return {
+            key: {**breaker.stats(), **limit.stats()}
+            for key, (breaker, limit) in list(cls._guards.items())
+        }
+
+    @staticmethod
+    def _retry_after(rsp):
+        value = rsp.headers.get("Retry-After") if rsp is not None else None
+        return int(value) if value and value.isdigit() else None
+
+    def _record(self, breaker, limit, rsp):
+        """Report outcome of a download to circuit breaker and concurrency limit
+        """
+        if rsp is None or rsp.status_code in self._throttled or rsp.status_code >= 500:
+            breaker.failure(self._retry_after(rsp))
+            limit.release(False)
+        else:
+            breaker.success()
+            limit.release(True)
 
-    def _download(self):
-        """Download and store response
+    def _ttl(self, endpoint, info):
+        """Return seconds to cache parsed info of endpoint, 0 if not cached
+        """
+        if info:
+            return self._cache_ttl.get(endpoint, 0)
+        # empty info may be a failed download, only cache confirmed ones
+        if self.empty:
+            return self._negative_ttl.get(endpoint, 0)
+        return 0
+
+    def _answers_stale(self, endpoint, info):
+        """Return True if upstream failed, was throttled or its circuit is
+        open, and endpoint keeps stale copies
+        """
+        return not info and not self.empty and endpoint in self._cache_ttl
+
+    async def _fetch_async(self, endpoint, params, parse):
+        """Return cached info of endpoint and params, otherwise download
+        self._url and return parse(*params), or the stale copy if upstream
+        cannot answer. Cache is accessed on executor threads.
+        """
+        loop = asyncio.get_running_loop()
+        name = f"{self._retailer}.{endpoint}"
+        self.empty = False
+        self.stale = False
+        info = None
+        if endpoint in self._cache_ttl or endpoint in self._negative_ttl:
+            info = await loop.run_in_executor(None, self._cache.get, name, params)
+        if info is None:
+            await self._download_async(endpoint)
+            info = parse(*params)
+            ttl = self._ttl(endpoint, info)
+            if ttl:
+                await loop.run_in_executor(
+                    None, self._cache.set, name, params, info, ttl, self._stale_ttl if info else 0
+                )
+            elif self._answers_stale(endpoint, info):
+                stale = await loop.run_in_executor(None, self._cache.get_stale, name, params)
+                if stale is not None:
+                    info, self.stale = stale, True
+        else:
+            self.empty = not info
+        return info
+
+    async def _download_async(self, endpoint=None):
+        """Download and store response without blocking the event loop,
+        through the guard of endpoint if given
         """
         if self._url is None:
             return
 
+        loop = asyncio.get_running_loop()
+        wait = float(os.environ.get("UPSTREAM_TOKEN_WAIT", "3"))
+        breaker, limit = self._guard(endpoint) if endpoint else (None, None)
+        if breaker is not None:
+            try:
+                if not await loop.run_in_executor(None, breaker.allow):
+                    logger.debug(f"{type(self).__name__} : circuit open {self._url}")
+                    return
+                acquired = await limit.acquire_async(wait)
+            except BaseException:
+                # cancelled before going upstream
+                breaker.cancel()
+                raise
+            if not acquired:
+                logger.debug(f"{type(self).__name__} : concurrency limited {self._url}")
+                breaker.cancel()
+                return
+
+        rsp = None
         try:
-            with requests.Session() as session:
-                session.mount("https://", self._adapter)
-                session.mount("http://", self._adapter)
-                rsp = session.get(self._url)
-        except requests.exceptions.ConnectionError:
-            logger.debug(f"{type(self).__name__} : {self._url}")
-        except:
-            logger.error(f"{type(self).__name__} : {self._url}")
-        else:
-            self._response = rsp
+            if self._retailer and not await self._bucket(self._url).wait_async(wait):
+                logger.debug(f"{type(self).__name__} : rate limited {self._url}")
+                if breaker is not None:
+                    breaker.cancel()
+                    limit.release(None)
+                return
+
+            for attempt in range(self._retries + 1):
+                if attempt:
+                    await asyncio.sleep(self._backoff_factor * (2 ** (attempt - 1)))
+                try:
+                    rsp = await self._client().get(self._url)
+                except httpx.TransportError:
+                    logger.debug(f"{type(self).__name__} : {self._url}")
+                    rsp = None
+                    continue
+                except Exception:
+                    logger.error(f"{type(self).__name__} : {self._url}")
+                    rsp = None
+                    break
+                # throttled calls and Retry-After are left to the circuit breaker
+                if rsp.status_code not in self._status_forcelist or self._retry_after(rsp) is not None:
+                    break
+        except BaseException:
+            # cancelled, e.g. client went away
+            if breaker is not None:
+                breaker.cancel()
+                limit.release(None)
+            raise
+        self._response = rsp
+        if breaker is not None:
+            await loop.run_in_executor(None, self._record, breaker, limit, rsp)
+
+    @classmethod
+    async def fetch_many(cls, calls, concurrency, deadline):
+        """Run async methods concurrently and yield results as they complete
+
+        Each call runs on its own scraper, since a scraper keeps state of one
+        download, and all of them share the pooled client of the event loop.
+        At most concurrency calls are in flight, each given deadline seconds
+        once started. Calls not consumed yet are cancelled if the caller stops.
+
+        Args:
+            calls (dict): key -> (name of async method, tuple of arguments)
+            concurrency (int): maximum calls in flight
+            deadline (float): seconds per call
+
+        Yields:
+            tuple: (key, scraper, result, error message or None)
+        """
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        async def run(key, method, args):
+            scraper = cls()
+            async with semaphore:
+                try:
+                    result = await asyncio.wait_for(getattr(scraper, method)(*args), deadline)
+                except asyncio.TimeoutError:
+                    logger.debug(f"{cls.__name__} : timed out {method} {args}")
+                    return key, scraper, None, "Timed out."
+                except Exception:
+                    logger.exception(f"{cls.__name__} : {method} {args}")
+                    return key, scraper, None, "Server error."
+            return key, scraper, result, None
+
+        tasks = [asyncio.ensure_future(run(key, method, args)) for key, (method, args) in calls.items()]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
 
 
 class ScraperTarget(ScraperBase):
     """Scraper for Target"""
+
+    _retailer = "tgt"
+    # store directories and SKU names change over weeks
+    _cache_ttl = {
+        "search": int(os.environ.get("SCRAPER_CACHE_TTL_SEARCH", "86400")),
+        "stores": int(os.environ.get("SCRAPER_CACHE_TTL_STORES", "604800")),
+    }
+    # a product may be listed or restocked any time
+    _negative_ttl = {
+        "search": int(os.environ.get("SCRAPER_NEGATIVE_TTL_SEARCH", "900")),
+        "quantity": int(os.environ.get("SCRAPER_NEGATIVE_TTL_QUANTITY", "300")),
+        "stores": int(os.environ.get("SCRAPER_NEGATIVE_TTL_STORES", "3600")),
+    }
+    # SKUs upstream answered 404 for, not looked up again until expired
+    _invalid_skus = BloomSet(
+        "tgt:sku",
+        int(os.environ.get("SCRAPER_INVALID_SKUS_CAPACITY", "100000")),
+        float(os.environ.get("SCRAPER_INVALID_SKUS_ERROR_RATE", "0.001")),
+        float(os.environ.get("SCRAPER_INVALID_SKUS_CHECK", "60")),
+        int(os.environ.get("SCRAPER_INVALID_SKUS_TTL", str(30 * 86400)))
+    )
     
-    def search_product(self, keyword):
+    @staticmethod
+    def _search_product_url(keyword):
         if not keyword.strip().isdigit() or len(keyword) not in (8, 9, 12, 13):
             return None
 
-        self._url = (
+        return (
             "https://redsky.target.com/redsky_aggregations/v1/web/plp_search_v1?"
             "key=9f36aeafbe60771e321a7cc95a78140772ab3e96&channel=WEB"
             f"&keyword={keyword}&page=/s/{keyword}&pricing_store_id=1296"
             "&visitor_id=017A6DC6EE8F1211A79B8E2D32284BE2"
         )
-        self._download()
+
+    def search_product(self, keyword):
+        return async_to_sync(self.search_product_async)(keyword)
+
+    async def search_product_async(self, keyword):
+        self._url = self._search_product_url(keyword)
+        if self._url is None:
+            return None
+
+        return await self._fetch_async("search", (keyword,), self._parse_search_product)
+
+    def _parse_search_product(self, keyword):
         info = dict()
         if self._response is not None and self._response.status_code == 200:
             try:
@@ -108,12 +353,16 @@ class ScraperTarget(ScraperBase):
                 name = StrAlnumSpaceConverter(data["item"]["product_description"]["title"]).value[:64]
                 info = {"sku": sku, "name": name}
             except IndexError:
-                pass
+                # no product matches keyword
+                self.empty = True
             except Exception:
                 logger.exception(f"{type(self).__name__} : {keyword}")
         return info
 
     def get_product_info_by_sku(self, sku):
+        return async_to_sync(self.get_product_info_by_sku_async)(sku)
+
+    async def get_product_info_by_sku_async(self, sku):
         # "81911643"
         if not sku.strip().isdigit() or len(sku) != 8:
             return None
@@ -123,7 +372,7 @@ class ScraperTarget(ScraperBase):
             f"key=9f36aeafbe60771e321a7cc95a78140772ab3e96&tcin={sku}&is_bot=false"
             "&pricing_store_id=1296"
         )
-        self._download()
+        await self._download_async("product")
         info = dict()
         if self._response is not None and self._response.status_code == 200:
             print(self._response)
@@ -135,18 +384,32 @@ class ScraperTarget(ScraperBase):
                 logger.exception(f"{type(self).__name__} : {sku}")
         return info
 
-    def get_qty_by_sku_zipcode(self, sku, zipcode):
+    @staticmethod
+    def _qty_by_sku_zipcode_url(sku, zipcode):
         # "81911643", "12011"
         if not sku.isdigit() or len(sku) != 8 or not zipcode.isdigit() or len(zipcode) != 5:
             return None
 
-        self._url = (
+        return (
             "https://redsky.target.com/redsky_aggregations/v1/web_platform/fiats_v1?"
             f"key=9f36aeafbe60771e321a7cc95a78140772ab3e96&tcin={sku}&nearby={zipcode}"
             "&radius=50&limit=20&include_only_available_stores=true&requested_quantity=0"
         )
-        self._download()
 
+    def get_qty_by_sku_zipcode(self, sku, zipcode):
+        return async_to_sync(self.get_qty_by_sku_zipcode_async)(sku, zipcode)
+
+    async def get_qty_by_sku_zipcode_async(self, sku, zipcode):
+        self._url = self._qty_by_sku_zipcode_url(sku, zipcode)
+        if self._url is None:
+            return None
+        if await asyncio.get_running_loop().run_in_executor(None, self._invalid_skus.__contains__, sku):
+            self.invalid = True
+            return None
+
+        return await self._fetch_async("quantity", (sku, zipcode), self._parse_qty_by_sku_zipcode)
+
+    def _parse_qty_by_sku_zipcode(self, sku, zipcode):
         info = []
         if self._response is not None and self._response.status_code == 200:
             try:
@@ -155,17 +418,83 @@ class ScraperTarget(ScraperBase):
                     # store_name = StrAlnumSpaceConverter(location["store"]["location_name"]).value
                     quantity = IntConverter(location["location_available_to_promise_quantity"]).value
                     info.append((sku, quantity, "tgt", store_id))
+                # no store nearby has the product
+                self.empty = not info
             except Exception:
                 logger.exception(f"{type(self).__name__} : {sku} - {zipcode}")
+        elif self._response is not None and self._response.status_code == 404:
+            # upstream does not know the SKU at all
+            self._invalid_skus.add(sku)
         return info
 
-    def get_stores_by_zipcode(self, zipcode):
-        self._url = (
+    @classmethod
+    def _qty_error(cls, sku, scraper, result):
+        # error message of a quantity result, None if confirmed by upstream
+        if result is None:
+            return "Unknown SKU." if scraper.invalid else "Invalid input."
+        if not result and not scraper.empty:
+            return "Download failed."
+        return None
+
+    @classmethod
+    async def iter_qty_by_skus_zipcodes(cls, pairs, concurrency, deadline):
+        """Get quantity of many (sku, zipcode) concurrently, see fetch_many
+
+        Yields:
+            tuple: (sku, zipcode, quantity rows or None, error message or None)
+                as soon as each completes. Rows of SKUs with no store nearby
+                are empty, rows are None on error.
+        """
+        calls = {
+            (sku, zipcode): ("get_qty_by_sku_zipcode_async", (sku, zipcode))
+            for sku, zipcode in dict.fromkeys(pairs)
+        }
+        async for (sku, zipcode), scraper, result, error in cls.fetch_many(calls, concurrency, deadline):
+            if error is None:
+                error = cls._qty_error(sku, scraper, result)
+            yield sku, zipcode, result if error is None else None, error
+
+    @classmethod
+    async def get_qty_by_skus_zipcode_async(cls, skus, zipcode, concurrency, deadline):
+        """Get quantity of many SKUs around one zipcode concurrently
+
+        Only SKUs confirmed by upstream are in info, SKUs with no store nearby
+        as empty rows, others are in errors.
+
+        Args:
+            skus (list): SKUs
+            zipcode (str): zipcode
+            concurrency (int): maximum concurrent downloads
+            deadline (float): seconds per download
+
+        Returns:
+            tuple: (dict of sku -> quantity rows, dict of sku -> error message)
+        """
+        info, errors = dict(), dict()
+        pairs = [(sku, zipcode) for sku in skus]
+        async for sku, _, rows, error in cls.iter_qty_by_skus_zipcodes(pairs, concurrency, deadline):
+            if error is None:
+                info[sku] = rows
+            else:
+                errors[sku] = error
+        return info, errors
+
+    @staticmethod
+    def _stores_by_zipcode_url(zipcode):
+        return (
             "https://api.target.com/location_proximities/v1/nearby_locations?limit=20"
             f"&unit=mile&within=100&place={zipcode}"
             "&type=store&key=8df66ea1e1fc070a6ea99e942431c9cd67a80f02"
         )
-        self._download()
+
+    def get_stores_by_zipcode(self, zipcode):
+        return async_to_sync(self.get_stores_by_zipcode_async)(zipcode)
+
+    async def get_stores_by_zipcode_async(self, zipcode):
+        self._url = self._stores_by_zipcode_url(zipcode)
+        return await self._fetch_async("stores", (zipcode,), self._parse_stores_by_zipcode)
+
+    def _parse_stores_by_zipcode(self, zipcode):
         info = []
         if self._response is not None and self._response.status_code == 200:
             try:
@@ -179,6 +508,8 @@ class ScraperTarget(ScraperBase):
                     latitude = location["geographic_specifications"]["latitude"]
                     longitude = location["geographic_specifications"]["longitude"]
                     info.append(("tgt", store_id, name, address, city, state, postal_code, latitude, longitude))
+                # no store around zipcode
+                self.empty = not info
             except Exception:
                 logger.exception(f"{type(self).__name__} : {zipcode}")
         return info
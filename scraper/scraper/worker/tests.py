@@ -1,3 +1,343 @@
-from django.test import TestCase
+"""
+Tests for upstream guards, response cache and concurrent fetches of scrapers
+Command line: python -m pytest ./worker/tests.py
+"""
 
-# Create your tests here.
+import asyncio
+import fakeredis
+import pytest
+import time
+from worker import utils
+from worker.scraper import ScraperBase, ScraperTarget
+from worker.utils import AdaptiveLimit, BloomSet, CircuitBreaker, ResponseCache
+
+
+@pytest.fixture
+def no_redis(monkeypatch):
+    monkeypatch.delenv("REDIS_HOST", raising=False)
+    monkeypatch.setattr(utils.RedisHandle, "_client", None)
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(utils.RedisHandle, "_client", client)
+    return client
+
+
+class TestCircuitBreaker:
+    def test_closed_open_half_open_closed(self, no_redis):
+        breaker = CircuitBreaker("test", threshold=2, reset=0.2)
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+        time.sleep(0.25)
+        # one probe at a time
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow()
+        breaker.success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow()
+        assert breaker.allow()
+
+    def test_failed_probe_opens(self, no_redis):
+        breaker = CircuitBreaker("test", threshold=1, reset=0.2)
+        breaker.failure()
+        time.sleep(0.25)
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+    def test_cancelled_probe_released(self, no_redis):
+        breaker = CircuitBreaker("test", threshold=1, reset=0.2)
+        breaker.failure()
+        time.sleep(0.25)
+        assert breaker.allow()
+        breaker.cancel()
+        assert breaker.allow()
+
+    def test_retry_after(self, no_redis):
+        breaker = CircuitBreaker("test", threshold=5, reset=0.2)
+        breaker.failure(retry_after=60)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+        assert breaker.stats()["open_for"] > 59
+
+    def test_retry_after_zero(self, no_redis):
+        breaker = CircuitBreaker("test", threshold=2, reset=0.2)
+        breaker.failure(retry_after=0)
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow()
+        breaker.failure(retry_after=0)
+        assert breaker.state == CircuitBreaker.OPEN
+
+
+class TestAdaptiveLimit:
+    def test_additive_increase(self):
+        limit = AdaptiveLimit("test", initial=4, minimum=1, maximum=8)
+        # about one per round of limit successful calls
+        for _ in range(5):
+            assert limit.acquire(0)
+            limit.release(True)
+        assert limit.stats() == {"limit": 5, "in_flight": 0}
+        for _ in range(100):
+            assert limit.acquire(0)
+            limit.release(True)
+        assert limit.stats()["limit"] == 8
+
+    def test_multiplicative_decrease(self):
+        limit = AdaptiveLimit("test", initial=8, minimum=1, maximum=8)
+        limit.acquire(0)
+        limit.release(False)
+        assert limit.stats()["limit"] == 4
+        for _ in range(5):
+            limit.acquire(0)
+            limit.release(False)
+        assert limit.stats()["limit"] == 1
+
+    def test_release_none_keeps_limit(self):
+        limit = AdaptiveLimit("test", initial=2, minimum=1, maximum=8)
+        limit.acquire(0)
+        limit.release(None)
+        assert limit.stats() == {"limit": 2, "in_flight": 0}
+
+    def test_wait_for_slot(self):
+        limit = AdaptiveLimit("test", initial=2, minimum=1, maximum=8)
+        assert limit.acquire(0)
+        assert limit.acquire(0)
+        assert not limit.acquire(0.05)
+        limit.release(None)
+        assert limit.acquire(0)
+
+    def test_acquire_async(self):
+        limit = AdaptiveLimit("test", initial=1, minimum=1, maximum=8)
+
+        async def run():
+            assert await limit.acquire_async(0)
+            assert not await limit.acquire_async(0.1)
+            asyncio.get_running_loop().call_later(0.1, limit.release, True)
+            return await limit.acquire_async(1)
+
+        assert asyncio.run(run())
+
+
+class TestResponseCache:
+    def test_memory_tier(self, no_redis):
+        cache = ResponseCache(1024)
+        cache.set("tgt.item", ("81911643",), {"name": "a"}, 60)
+        assert cache.get("tgt.item", (" 81911643 ",)) == {"name": "a"}
+        assert cache.get("tgt.item", ("00000000",)) is None
+        assert cache.stats() == {"tgt.item": {"memory_hit": 1, "miss": 1}}
+
+    def test_memory_evicts_least_recent(self, no_redis):
+        cache = ResponseCache(20)
+        cache.set("e", ("a",), "x" * 6, 60)
+        cache.set("e", ("b",), "y" * 6, 60)
+        cache.get("e", ("a",))
+        cache.set("e", ("c",), "z" * 6, 60)
+        assert cache.get("e", ("b",)) is None
+        assert cache.get("e", ("a",)) == "x" * 6
+        assert cache.get("e", ("c",)) == "z" * 6
+
+    def test_memory_expiry(self, no_redis):
+        cache = ResponseCache(1024)
+        cache.set("e", ("a",), [], 0.1)
+        assert cache.get("e", ("a",)) == []
+        time.sleep(0.15)
+        assert cache.get("e", ("a",)) is None
+
+    def test_redis_tier(self, redis_client):
+        ResponseCache(1024).set("e", ("a",), [1], 60)
+        # another process
+        cache = ResponseCache(1024, flush=0)
+        assert cache.get("e", ("a",)) == [1]
+        assert cache.get("e", ("a",)) == [1]
+        assert cache.stats() == {"e": {"redis_hit": 1, "memory_hit": 1}}
+
+    def test_stale_copy(self, redis_client):
+        cache = ResponseCache(1024)
+        cache.set("e", ("a",), [1], 60, stale_ttl=600)
+        redis_client.delete("scraper:cache:e:a")
+        assert ResponseCache(1024).get("e", ("a",)) is None
+        assert cache.get_stale("e", ("a",)) == [1]
+        assert redis_client.ttl("scraper:stale:e:a") > 60
+
+    def test_counts_flushed(self, redis_client):
+        cache = ResponseCache(1024, flush=60)
+        cache.set("e", ("a",), [1], 60)
+        for _ in range(3):
+            cache.get("e", ("a",))
+        # counted in memory until flush seconds pass
+        assert not redis_client.exists("scraper:cache:stats:e")
+        assert cache.stats() == {"e": {"memory_hit": 3}}
+        assert redis_client.hgetall("scraper:cache:stats:e") == {b"memory_hit": b"3"}
+
+
+class TestBloomSet:
+    def test_new_item_seen_elsewhere(self, redis_client):
+        writer = BloomSet("test", 100, 0.01, check=0, ttl=60)
+        reader = BloomSet("test", 100, 0.01, check=0, ttl=60)
+        writer.add("1")
+        assert "1" in reader
+        # one item expires as another arrives, same cardinality
+        redis_client.zadd("bloom:test:expiry", {"1": time.time() - 1})
+        writer.add("2")
+        assert redis_client.zcard("bloom:test:expiry") == 2
+        assert "2" in reader
+        assert "1" not in reader
+
+    def test_refreshed_item_keeps_version(self, redis_client):
+        bloom = BloomSet("test", 100, 0.01, check=0, ttl=60)
+        bloom.add("1")
+        bloom.add("1")
+        assert redis_client.get("bloom:test:version") == b"1"
+
+    def test_without_redis(self, no_redis):
+        bloom = BloomSet("test", 100, 0.01, check=0, ttl=60)
+        bloom.add("1")
+        assert "1" in bloom
+        assert "2" not in bloom
+
+
+class NegativeScraper(ScraperBase):
+    _negative_ttl = {"item": 0.2}
+
+    def __init__(self):
+        super().__init__()
+        self.parsed = 0
+
+    def _parse(self, keyword):
+        self.parsed += 1
+        self.empty = True
+        return []
+
+
+class TestNegativeCache:
+    @staticmethod
+    def fetch(scraper, parse):
+        return asyncio.run(scraper._fetch_async("item", ("unknown",), parse))
+
+    def test_expiry(self, no_redis, monkeypatch):
+        monkeypatch.setattr(ScraperBase, "_cache", ResponseCache(1024))
+        scraper = NegativeScraper()
+        assert self.fetch(scraper, scraper._parse) == []
+        assert self.fetch(scraper, scraper._parse) == []
+        assert scraper.empty
+        assert scraper.parsed == 1
+        time.sleep(0.25)
+        self.fetch(scraper, scraper._parse)
+        assert scraper.parsed == 2
+
+    def test_failure_not_cached(self, no_redis, monkeypatch):
+        monkeypatch.setattr(ScraperBase, "_cache", ResponseCache(1024))
+        scraper = NegativeScraper()
+        # download failed, nothing parsed and not confirmed empty
+        self.fetch(scraper, lambda keyword: [])
+        assert not scraper.empty
+        assert self.fetch(scraper, scraper._parse) == []
+        assert scraper.parsed == 1
+
+
+class TestSyncWrapper:
+    def test_runs_async_method(self, no_redis, monkeypatch):
+        invalid_skus = BloomSet("test", 100, 0.01, check=0, ttl=60)
+        invalid_skus.add("12345678")
+        monkeypatch.setattr(ScraperTarget, "_invalid_skus", invalid_skus)
+        scraper = ScraperTarget()
+        assert scraper.get_qty_by_sku_zipcode("12345678", "92128") is None
+        assert scraper.invalid
+        scraper = ScraperTarget()
+        assert scraper.get_qty_by_sku_zipcode("1234", "92128") is None
+        assert not scraper.invalid
+
+
+class SleepScraper(ScraperBase):
+    running = 0
+    most = 0
+    cancelled = []
+
+    async def sleep(self, seconds, value):
+        cls = type(self)
+        cls.running += 1
+        cls.most = max(cls.most, cls.running)
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            cls.cancelled.append(value)
+            raise
+        finally:
+            cls.running -= 1
+        return value
+
+    async def fail(self):
+        raise ValueError("parse error")
+
+
+class TestFetchMany:
+    @pytest.fixture(autouse=True)
+    def reset(self, monkeypatch):
+        monkeypatch.setattr(SleepScraper, "running", 0)
+        monkeypatch.setattr(SleepScraper, "most", 0)
+        monkeypatch.setattr(SleepScraper, "cancelled", [])
+
+    @staticmethod
+    def collect(calls, concurrency=10, deadline=1):
+        async def run():
+            return [item async for item in SleepScraper.fetch_many(calls, concurrency, deadline)]
+
+        return asyncio.run(run())
+
+    def test_completion_order(self):
+        results = self.collect({
+            "slow": ("sleep", (0.2, 1)),
+            "fast": ("sleep", (0, 2)),
+            "medium": ("sleep", (0.1, 3)),
+        })
+        assert [(key, result, error) for key, _, result, error in results] == [
+            ("fast", 2, None), ("medium", 3, None), ("slow", 1, None)
+        ]
+        assert all(isinstance(scraper, SleepScraper) for _, scraper, _, _ in results)
+
+    def test_deadline(self):
+        start = time.monotonic()
+        results = self.collect({"late": ("sleep", (5, 1)), "ok": ("sleep", (0, 2))}, deadline=0.1)
+        assert time.monotonic() - start < 1
+        assert {key: (result, error) for key, _, result, error in results} == {
+            "late": (None, "Timed out."), "ok": (2, None)
+        }
+        assert SleepScraper.cancelled == [1]
+
+    def test_error(self):
+        results = self.collect({"error": ("fail", ()), "ok": ("sleep", (0, 2))})
+        assert {key: (result, error) for key, _, result, error in results} == {
+            "error": (None, "Server error."), "ok": (2, None)
+        }
+
+    def test_concurrency(self):
+        results = self.collect({key: ("sleep", (0.05, key)) for key in range(6)}, concurrency=2)
+        assert sorted(result for _, _, result, _ in results) == list(range(6))
+        assert SleepScraper.most == 2
+
+    def test_cancel_on_stop(self):
+        async def run():
+            calls = {"fast": ("sleep", (0, 1)), "slow": ("sleep", (5, 2)), "queued": ("sleep", (5, 3))}
+            results = SleepScraper.fetch_many(calls, 2, 10)
+            first = await results.__anext__()
+            await results.aclose()
+            # let cancelled calls unwind
+            await asyncio.sleep(0)
+            return first
+
+        start = time.monotonic()
+        assert asyncio.run(run())[0] == "fast"
+        assert time.monotonic() - start < 1
+        # the queued call took the slot of the fast one, both are cancelled
+        assert sorted(SleepScraper.cancelled) == [2, 3]
+        assert SleepScraper.running == 0
@@ -25,8 +25,20 @@ urlpatterns = [
         "target/store/<str:zipcode>/",
         views.target_get_stores_by_zipcode
     ),
+    path(
+        "target/quantity/batch/",
+        views.target_get_quantities_by_skus_zipcode
+    ),
+    path(
+        "target/quantity/stream/",
+        views.target_stream_quantities_by_skus_zipcode
+    ),
     path(
         "target/quantity/<str:sku>/<str:zipcode>/",
         views.target_get_quantities_by_sku_zipcode
     ),
+    path(
+        "stats/",
+        views.get_stats
+    ),
 ]
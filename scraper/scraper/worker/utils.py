@@ -1,10 +1,685 @@
+import asyncio
+from collections import OrderedDict
 import decimal
+import hashlib
+import json
 from loguru import logger
+import math
+import os
 import re
+import redis
+import threading
+import time
 
 logger.add("logs/default.log")
 
 
+class RedisHandle:
+    """Process-wide Redis client shared with the shopping service, optional
+
+    redis-py clients are thread-safe and their connection pools reset themselves
+    after fork, so one client per process is enough. Without REDIS_HOST the
+    scraper runs standalone and client() returns None.
+    """
+
+    _client = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def client(cls):
+        """
+
+        Returns:
+            redis.Redis/NoneType: client, None if Redis is not configured
+        """
+        if cls._client is None and os.environ.get("REDIS_HOST"):
+            with cls._lock:
+                if cls._client is None:
+                    cls._client = redis.Redis(
+                        host=os.environ.get("REDIS_HOST"),
+                        port=int(os.environ.get("REDIS_PORT", "6379")),
+                        username=os.environ.get("REDIS_USER"),
+                        password=os.environ.get("REDIS_PASSWORD"),
+                        db=int(os.environ.get("REDIS_CACHE_DB", "1")),
+                        socket_timeout=1,
+                        socket_connect_timeout=1
+                    )
+        return cls._client
+
+
+class TokenBucket:
+    """Distributed token bucket backed by Redis
+
+    All processes using the same name share one bucket refilled at rate tokens
+    per second up to burst tokens. Refill and take run atomically in Redis on
+    its own clock, so hosts with skewed clocks still agree. If Redis fails,
+    calls are allowed rather than blocked.
+    """
+
+    # return seconds to wait for next token, 0 if a token is taken
+    _take_script = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or burst
+        local ts = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, name, rate, burst):
+        """
+
+        Args:
+            name (str): key of bucket, e.g. retailer and endpoint
+            rate (float): tokens refilled per second
+            burst (int): maximum tokens
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def acquire(self):
+        """Take a token without waiting
+
+        Returns:
+            float: 0 if a token is taken, otherwise seconds until next token
+        """
+        client = RedisHandle.client()
+        if client is None:
+            return 0
+        try:
+            return float(client.eval(
+                self._take_script, 1, f"ratelimit:{self.name}", self.rate, self.burst
+            ))
+        except Exception:
+            logger.exception(f"{type(self).__name__} : {self.name}")
+            return 0
+
+    def wait(self, timeout):
+        """Take a token, waiting at most timeout seconds
+
+        Returns:
+            bool: True if a token is taken
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            delay = self.acquire()
+            if delay <= 0:
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+
+    async def wait_async(self, timeout):
+        """Take a token like wait, sleeping without blocking the event loop
+
+        Returns:
+            bool: True if a token is taken
+        """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            delay = await loop.run_in_executor(None, self.acquire)
+            if delay <= 0:
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Circuit breaker of one upstream endpoint
+
+    - closed: calls go upstream, consecutive failures are counted
+    - open: calls fail fast for reset seconds after threshold consecutive
+      failures, or for as long as upstream asked with Retry-After
+    - half-open: then one call at a time probes upstream, a success closes
+      the circuit and a failure opens it again
+    Openings are shared through Redis if configured, so that a throttle seen
+    by one process stops all of them. Redis errors are ignored.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, threshold, reset):
+        """
+
+        Args:
+            name (str): key of circuit, e.g. retailer and endpoint
+            threshold (int): consecutive failures opening the circuit
+            reset (float): seconds the circuit stays open
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+        self.state = self.CLOSED
+        self._failures = 0
+        self._until = 0
+        # a probe not reported within reset seconds is given up
+        self._probe = 0
+        self._lock = threading.Lock()
+
+    def _remote_until(self):
+        client = RedisHandle.client()
+        if client is None:
+            return 0
+        try:
+            value = client.get(f"circuit:{self.name}")
+        except Exception:
+            logger.debug(f"{type(self).__name__} : get {self.name}")
+            return 0
+        return float(value) if value is not None else 0
+
+    def allow(self):
+        """
+
+        Returns:
+            bool: True if the call may go upstream, False to fail fast
+        """
+        until = self._remote_until()
+        with self._lock:
+            now = time.time()
+            if until > now and until > self._until:
+                # opened by another process
+                self.state = self.OPEN
+                self._until = until
+            if self.state == self.OPEN:
+                if now < self._until:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe = 0
+            if self.state == self.HALF_OPEN:
+                if now < self._probe:
+                    return False
+                self._probe = now + self.reset
+            return True
+
+    def cancel(self):
+        """Give up a call allowed by allow() before it went upstream, so that
+        a half-open circuit lets the next call probe instead
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe = 0
+
+    def success(self):
+        with self._lock:
+            closed = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self._failures = 0
+        if closed:
+            logger.info(f"{type(self).__name__} : {self.name} closed")
+            client = RedisHandle.client()
+            if client is not None:
+                try:
+                    client.delete(f"circuit:{self.name}")
+                except Exception:
+                    logger.debug(f"{type(self).__name__} : delete {self.name}")
+
+    def failure(self, retry_after=None):
+        """
+
+        Args:
+            retry_after (int, optional): seconds upstream asked to wait,
+                opens the circuit at once for as long if positive, otherwise
+                counted as any failure. Defaults to None.
+        """
+        if retry_after is not None and retry_after <= 0:
+            retry_after = None
+        with self._lock:
+            self._failures += 1
+            if retry_after is None and self.state == self.CLOSED and self._failures < self.threshold:
+                return
+            seconds = retry_after if retry_after is not None else self.reset
+            self.state = self.OPEN
+            self._until = time.time() + seconds
+            until = self._until
+        logger.warning(f"{type(self).__name__} : {self.name} open for {seconds}s")
+        client = RedisHandle.client()
+        if client is not None and seconds > 0:
+            try:
+                client.set(f"circuit:{self.name}", until, ex=math.ceil(seconds))
+            except Exception:
+                logger.debug(f"{type(self).__name__} : set {self.name}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self._failures,
+                "open_for": max(round(self._until - time.time(), 1), 0) if self.state == self.OPEN else 0,
+            }
+
+
+class AdaptiveLimit:
+    """Concurrency limit of one upstream endpoint adapted by AIMD
+
+    The limit grows by one per round of limit successful calls up to maximum
+    and halves on each failed or throttled call down to minimum, so that a
+    throttling upstream sees fewer calls at once instead of retries. Calls
+    beyond the limit wait for a slot. Shared by threads and event loops of one
+    process.
+    """
+
+    def __init__(self, name, initial, minimum, maximum):
+        """
+
+        Args:
+            name (str): key of limit, e.g. retailer and endpoint
+            initial (int): initial limit
+            minimum (int): lowest limit, at least 1
+            maximum (int): highest limit, e.g. connection pool size
+        """
+        self.name = name
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def _available(self):
+        return self._in_flight < int(self.limit)
+
+    def acquire(self, timeout):
+        """Take a slot, waiting at most timeout seconds
+
+        Returns:
+            bool: True if a slot is taken, release it with release()
+        """
+        with self._cond:
+            if not self._cond.wait_for(self._available, timeout):
+                return False
+            self._in_flight += 1
+            return True
+
+    async def acquire_async(self, timeout):
+        """Take a slot like acquire, polling without blocking the event loop
+
+        Returns:
+            bool: True if a slot is taken, release it with release()
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.acquire(0):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+
+    def release(self, ok):
+        """Free a slot and adapt the limit to the outcome of the call
+
+        Args:
+            ok (bool/NoneType): True if upstream answered, False if it failed or
+                throttled, None to keep the limit
+        """
+        with self._cond:
+            self._in_flight -= 1
+            if ok:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            elif ok is not None:
+                limit = max(self.limit / 2, self.minimum)
+                if int(limit) < int(self.limit):
+                    logger.info(f"{type(self).__name__} : {self.name} limit {int(limit)}")
+                self.limit = limit
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"limit": int(self.limit), "in_flight": self._in_flight}
+
+
+class ResponseCache:
+    """TTL cache of parsed upstream responses with a memory and a Redis tier
+
+    Values are kept as JSON text keyed by endpoint and normalized parameters.
+    The memory tier of each process evicts least recently used entries beyond
+    max_bytes, the Redis tier is shared by all scraper processes and survives
+    restarts. Values may also be kept in Redis past their TTL as stale copies,
+    served when upstream cannot answer. Hits and misses are counted per
+    endpoint in memory, and added to counters in Redis at most every flush
+    seconds if configured. Redis errors are logged and treated as misses.
+    """
+
+    def __init__(self, max_bytes, flush=10):
+        """
+
+        Args:
+            max_bytes (int): maximum size of JSON text kept in memory
+            flush (float, optional): seconds between additions of counts to
+                Redis. Defaults to 10.
+        """
+        self.max_bytes = max_bytes
+        self.flush = flush
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._counts = dict()
+        # counted since last addition to Redis
+        self._pending = dict()
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(endpoint, params):
+        return f"{endpoint}:" + ":".join(str(param).strip().lower() for param in params)
+
+    def _count(self, endpoint, field):
+        with self._lock:
+            for totals in (self._counts, self._pending):
+                counts = totals.setdefault(endpoint, dict())
+                counts[field] = counts.get(field, 0) + 1
+            if time.monotonic() - self._flushed < self.flush:
+                return
+        self._flush()
+
+    def _flush(self):
+        """Add counts since last addition to counters in Redis
+        """
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+            self._flushed = time.monotonic()
+        client = RedisHandle.client()
+        if client is None or not pending:
+            return
+        try:
+            pipe = client.pipeline(transaction=False)
+            for endpoint, counts in pending.items():
+                for field, count in counts.items():
+                    pipe.hincrby(f"scraper:cache:stats:{endpoint}", field, count)
+            pipe.execute()
+        except Exception:
+            logger.debug(f"{type(self).__name__} : flush")
+
+    def _remember(self, key, text, expires):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            if len(text) > self.max_bytes:
+                return
+            self._entries[key] = (text, expires)
+            self._bytes += len(text)
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def get(self, endpoint, params):
+        """
+
+        Args:
+            endpoint (str): endpoint name
+            params (tuple): parameters of the call
+
+        Returns:
+            type: cached value, None if not cached
+        """
+        key = self._key(endpoint, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(key)
+                else:
+                    del self._entries[key]
+                    self._bytes -= len(entry[0])
+                    entry = None
+        if entry is not None:
+            self._count(endpoint, "memory_hit")
+            return json.loads(entry[0])
+
+        client = RedisHandle.client()
+        if client is not None:
+            try:
+                pipe = client.pipeline()
+                pipe.get(f"scraper:cache:{key}")
+                pipe.ttl(f"scraper:cache:{key}")
+                text, ttl = pipe.execute()
+            except Exception:
+                logger.exception(f"{type(self).__name__} : get {key}")
+                text = None
+            if text is not None:
+                text = text.decode("utf-8")
+                self._remember(key, text, time.time() + max(ttl, 1))
+                self._count(endpoint, "redis_hit")
+                return json.loads(text)
+        self._count(endpoint, "miss")
+        return None
+
+    def set(self, endpoint, params, value, ttl, stale_ttl=0):
+        """Cache JSON-serializable value for ttl seconds
+
+        Args:
+            endpoint (str): endpoint name
+            params (tuple): parameters of the call
+            value (type): value
+            ttl (int): seconds
+            stale_ttl (int, optional): seconds to keep a stale copy in Redis,
+                0 for none. Defaults to 0.
+        """
+        key = self._key(endpoint, params)
+        text = json.dumps(value)
+        self._remember(key, text, time.time() + ttl)
+        client = RedisHandle.client()
+        if client is None:
+            return
+        try:
+            pipe = client.pipeline()
+            pipe.set(f"scraper:cache:{key}", text, ex=ttl)
+            if stale_ttl > ttl:
+                pipe.set(f"scraper:stale:{key}", text, ex=stale_ttl)
+            pipe.execute()
+        except Exception:
+            logger.exception(f"{type(self).__name__} : set {key}")
+
+    def get_stale(self, endpoint, params):
+        """
+
+        Args:
+            endpoint (str): endpoint name
+            params (tuple): parameters of the call
+
+        Returns:
+            type: last value cached, even if expired, None if none
+        """
+        key = self._key(endpoint, params)
+        client = RedisHandle.client()
+        if client is None:
+            return None
+        try:
+            text = client.get(f"scraper:stale:{key}")
+        except Exception:
+            logger.exception(f"{type(self).__name__} : get_stale {key}")
+            return None
+        if text is None:
+            return None
+        self._count(endpoint, "stale_hit")
+        return json.loads(text)
+
+    def stats(self):
+        """
+
+        Returns:
+            dict: endpoint -> counter -> count, of all processes if Redis is
+                configured, otherwise of this process
+        """
+        self._flush()
+        client = RedisHandle.client()
+        if client is not None:
+            try:
+                stats = dict()
+                for key in client.scan_iter(match="scraper:cache:stats:*"):
+                    endpoint = key.decode("utf-8").rsplit(":", 1)[1]
+                    stats[endpoint] = {
+                        field.decode("utf-8"): int(count)
+                        for field, count in client.hgetall(key).items()
+                    }
+                return stats
+            except Exception:
+                logger.exception(f"{type(self).__name__} : stats")
+        with self._lock:
+            return {endpoint: dict(counts) for endpoint, counts in self._counts.items()}
+
+
+class BloomFilter:
+    """Compact set of items with false positives but no false negatives
+
+    Sized for capacity items at error_rate false positives. The bit positions
+    of an item are derived from one blake2b digest by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+
+        Args:
+            capacity (int): expected number of items
+            error_rate (float): false positive rate at capacity, e.g. 0.001
+        """
+        self.size = max(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class BloomSet:
+    """Set of items known for ttl seconds, e.g. invalid SKUs, checked locally
+
+    Items are persisted in a Redis sorted set scored by expiry time, shared
+    with the shopping service, with a version counter bumped on each new
+    item. Each process keeps a BloomFilter of unexpired items, rebuilt on
+    first use, e.g. at worker start, and whenever the version changed
+    elsewhere, checked at most every check seconds. The filter only
+    rules items out: its hits are confirmed in Redis, since they may be false
+    positives or expired. Without Redis, the local filter is used as is, and
+    if Redis fails, items are not considered known.
+    """
+
+    def __init__(self, name, capacity, error_rate, check, ttl):
+        """
+
+        Args:
+            name (str): key of set
+            capacity (int): expected number of items, grown if exceeded
+            error_rate (float): false positive rate at capacity
+            check (float): seconds between checks whether the set changed
+            ttl (int): seconds an item stays known after added
+        """
+        self.name = name
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.check = check
+        self.ttl = ttl
+        self._key = f"bloom:{name}:expiry"
+        self._version_key = f"bloom:{name}:version"
+        self._filter = BloomFilter(capacity, error_rate)
+        self._version = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Rebuild filter from all unexpired items persisted in Redis
+
+        Returns:
+            bool: True if loaded
+        """
+        client = RedisHandle.client()
+        if client is None:
+            self._checked = time.monotonic()
+            return False
+        try:
+            pipe = client.pipeline()
+            pipe.get(self._version_key)
+            pipe.zremrangebyscore(self._key, "-inf", time.time())
+            pipe.zrange(self._key, 0, -1)
+            version, _, members = pipe.execute()
+        except Exception:
+            logger.exception(f"{type(self).__name__} : load {self.name}")
+            self._checked = time.monotonic()
+            return False
+        bloom = BloomFilter(max(self.capacity, 2 * len(members)), self.error_rate)
+        for member in members:
+            bloom.add(member.decode("utf-8"))
+        with self._lock:
+            self._filter = bloom
+            self._version = int(version or 0)
+            self._checked = time.monotonic()
+        logger.debug(f"{type(self).__name__} : {len(members)} {self.name} loaded")
+        return True
+
+    def _refresh(self):
+        if self._checked is not None and time.monotonic() - self._checked < self.check:
+            return
+        client = RedisHandle.client()
+        version = None
+        if client is not None:
+            try:
+                version = int(client.get(self._version_key) or 0)
+            except Exception:
+                logger.exception(f"{type(self).__name__} : version {self.name}")
+        if version is not None and version != self._version:
+            self.load()
+        else:
+            self._checked = time.monotonic()
+
+    def add(self, item):
+        """Add item locally and persist it for ttl seconds for other processes
+        """
+        with self._lock:
+            self._filter.add(item)
+        client = RedisHandle.client()
+        if client is None:
+            return
+        try:
+            # a new item tells other processes to reload, a known one only
+            # lives longer
+            if client.zadd(self._key, {item: time.time() + self.ttl}):
+                version = client.incr(self._version_key)
+                with self._lock:
+                    # no other change in between, this process is up to date
+                    if self._version is not None and version == self._version + 1:
+                        self._version = version
+        except Exception:
+            logger.exception(f"{type(self).__name__} : add {self.name} {item}")
+
+    def __contains__(self, item):
+        self._refresh()
+        if item not in self._filter:
+            return False
+        client = RedisHandle.client()
+        if client is None:
+            return True
+        try:
+            expiry = client.zscore(self._key, item)
+        except Exception:
+            logger.exception(f"{type(self).__name__} : check {self.name} {item}")
+            return False
+        return expiry is not None and expiry > time.time()
+
+
 class ValueConverter:
     """Base class to convert value to desired type
     It can be initialized with given value, attribute `value` is converted
@@ -1,18 +1,72 @@
-from django.http import JsonResponse
-from worker.scraper import ScraperTarget
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+import json
+from worker.scraper import ScraperBase, ScraperTarget
 
 
 # Create your views here.
-def target_search_products(request, keyword):
-    info = ScraperTarget().search_product(keyword)
-    return JsonResponse({"info": info})
+# "empty" tells callers that upstream confirmed there is no result,
+# as opposed to a failed download, so they may skip asking again.
+# "stale" tells that info is the last answer since upstream could not answer.
+async def target_search_products(request, keyword):
+    scraper = ScraperTarget()
+    info = await scraper.search_product_async(keyword)
+    return JsonResponse({"info": info, "empty": scraper.empty, "stale": scraper.stale})
 
 
-def target_get_stores_by_zipcode(request, zipcode):
-    info = ScraperTarget().get_stores_by_zipcode(zipcode)
-    return JsonResponse({"info": info})
+async def target_get_stores_by_zipcode(request, zipcode):
+    scraper = ScraperTarget()
+    info = await scraper.get_stores_by_zipcode_async(zipcode)
+    return JsonResponse({"info": info, "empty": scraper.empty, "stale": scraper.stale})
 
 
-def target_get_quantities_by_sku_zipcode(request, sku, zipcode):
-    info = ScraperTarget().get_qty_by_sku_zipcode(sku, zipcode)
-    return JsonResponse({"info": info})
+async def target_get_quantities_by_sku_zipcode(request, sku, zipcode):
+    scraper = ScraperTarget()
+    info = await scraper.get_qty_by_sku_zipcode_async(sku, zipcode)
+    if scraper.invalid:
+        return JsonResponse({"info": None, "empty": False, "message": "Unknown SKU."}, status=404)
+    return JsonResponse({"info": info, "empty": scraper.empty})
+
+
+def _batch_params(request):
+    # ?zipcode=12011&skus=81911643,13474204, error response if invalid
+    zipcode = request.GET.get("zipcode", "").strip()
+    skus = [sku.strip() for sku in request.GET.get("skus", "").split(",") if sku.strip()]
+    if not zipcode.isdigit() or len(zipcode) != 5 or not skus:
+        return zipcode, skus, JsonResponse({"info": dict(), "errors": dict(), "message": "Invalid input."}, status=400)
+    if len(skus) > settings.QUANTITY_BATCH_MAX_SKUS:
+        return zipcode, skus, JsonResponse({"info": dict(), "errors": dict(), "message": "Too many SKUs."}, status=400)
+    return zipcode, skus, None
+
+
+async def target_get_quantities_by_skus_zipcode(request):
+    zipcode, skus, error = _batch_params(request)
+    if error is not None:
+        return error
+
+    info, errors = await ScraperTarget.get_qty_by_skus_zipcode_async(
+        skus, zipcode, settings.QUANTITY_BATCH_WORKERS, settings.QUANTITY_BATCH_DEADLINE
+    )
+    return JsonResponse({"info": info, "errors": errors, "message": ""})
+
+
+async def target_stream_quantities_by_skus_zipcode(request):
+    # same input as the batch view, one NDJSON line per SKU as soon as its
+    # download completes: {"sku", "zipcode", "info", "error"}
+    zipcode, skus, error = _batch_params(request)
+    if error is not None:
+        return error
+
+    async def lines():
+        async for sku, _, rows, message in ScraperTarget.iter_qty_by_skus_zipcodes(
+            [(sku, zipcode) for sku in skus], settings.QUANTITY_BATCH_WORKERS, settings.QUANTITY_BATCH_DEADLINE
+        ):
+            yield json.dumps({"sku": sku, "zipcode": zipcode, "info": rows, "error": message}) + "\n"
+
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+
+
+def get_stats(request):
+    # hit/miss counters of cached endpoints, i.e. upstream calls saved, and
+    # circuit state and concurrency limit per endpoint of this process
+    return JsonResponse({"cache": ScraperBase._cache.stats(), "upstream": ScraperTarget.guard_stats()})
@@ -0,0 +1,49 @@
+"""Gunicorn config for production serving
+
+Run with: gunicorn -c gunicorn.conf.py shopping.asgi:application
+Reload code and workers gracefully with: kill -HUP <master pid>
+All settings can be overridden with GUNICORN_* environment variables, see
+"Serving" in README.md for tuning.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# Async views wait for upstream I/O on the event loop, so one uvicorn worker
+# per core is enough to hold hundreds of in-flight requests.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "uvicorn.workers.UvicornWorker")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+# only used by the gthread worker class
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+
+# Recycle workers after max_requests +- jitter requests to bound memory growth,
+# jitter avoids all workers restarting at the same time.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+# Inventory waits at most INVENTORY_FETCH_DEADLINE for quantity, then MySQL
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+# time for in-flight requests to finish on reload, recycling or shutdown
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+# nginx keeps upstream connections alive
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Workers import the app after fork, so HUP reloads code and no MySQL, Redis
+# or HTTP connection is shared across processes.
+preload_app = False
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG", "-")
+loglevel = os.environ.get("GUNICORN_LOGLEVEL", "info")
+
+
+def post_worker_init(worker):
+    # load in-process store index and invalid SKUs before serving requests
+    from product.cache import StoreIndex
+    from product.tasks import invalid_skus
+    try:
+        StoreIndex.refresh(force=True)
+    except Exception:
+        worker.log.exception("Failed to load store index")
+    invalid_skus.load()
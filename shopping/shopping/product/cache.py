@@ -0,0 +1,327 @@
+"""Cache Module"""
+
+from django.conf import settings
+from product.data import ProductMySQLInterface
+from product.utils import GeoIndex, RedisHandle
+from loguru import logger
+import threading
+import time
+
+logger.add("logs/default.log")
+
+
+class InventoryCache:
+    """Read-through cache of list_all_inventory GeoJSON text per (userid, zipcode)
+
+    Besides the cached text, two kinds of index sets record which cache keys
+    depend on what, so that only relevant entries are invalidated:
+    - inventory:user:<userid> for products added or updated by the user
+    - inventory:product:<store>:<sku> for quantity of a tracked product
+    Each index has a generation counter, inventory:gen:<index>, incremented on
+    invalidation. Text read from MySQL is only cached if the generations read
+    before the query are unchanged, so that text read before a concurrent
+    write is not cached after its invalidation.
+    Redis errors are logged and treated as cache misses.
+    """
+
+    # set text and index it if no generation changed since read
+    _set_script = """
+        local n = tonumber(ARGV[3])
+        for i = 1, n do
+            if (redis.call('GET', KEYS[1 + i]) or '') ~= ARGV[3 + i] then
+                return 0
+            end
+        end
+        redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+        for i = n + 2, #KEYS do
+            redis.call('SADD', KEYS[i], KEYS[1])
+            redis.call('EXPIRE', KEYS[i], ARGV[2])
+        end
+        return 1
+    """
+
+    @staticmethod
+    def _key(userid, zipcode):
+        return f"inventory:{userid}:{zipcode}"
+
+    @staticmethod
+    def _user_index(userid):
+        return f"inventory:user:{userid}"
+
+    @staticmethod
+    def _product_index(store, sku):
+        return f"inventory:product:{store}:{sku}"
+
+    @staticmethod
+    def _generation_key(index):
+        return f"inventory:gen:{index}"
+
+    @classmethod
+    def _indexes(cls, userid, products):
+        indexes = [cls._user_index(userid)]
+        indexes.extend(
+            cls._product_index(product.get("store"), product.get("sku"))
+            for product in products
+        )
+        return indexes
+
+    @classmethod
+    def get(cls, userid, zipcode):
+        """
+
+        Returns:
+            str/NoneType: cached GeoJSON text, None if not cached
+        """
+        try:
+            value = RedisHandle.client().get(cls._key(userid, zipcode))
+        except Exception:
+            logger.exception(f"{cls.__name__} : get {userid}-{zipcode}")
+            return None
+        return value.decode("utf-8") if value is not None else None
+
+    @classmethod
+    def generation(cls, userid, products):
+        """Read generations of user and tracked products, before reading the
+        text to cache from MySQL
+
+        Returns:
+            list/NoneType: generations to pass to set(), None if Redis failed
+        """
+        keys = [cls._generation_key(index) for index in cls._indexes(userid, products)]
+        try:
+            values = RedisHandle.client().mget(keys)
+        except Exception:
+            logger.exception(f"{cls.__name__} : generation {userid}")
+            return None
+        return [value.decode("utf-8") if value is not None else "" for value in values]
+
+    @classmethod
+    def set(cls, userid, zipcode, text, products, generation):
+        """Cache GeoJSON text and index it by user and tracked products, unless
+        any of them was invalidated since generation was read
+
+        Args:
+            userid (int): userid
+            zipcode (str): zipcode
+            text (str): GeoJSON text
+            products (list): tracked products as dict with "sku" and "store"
+            generation (list): generations read by generation() before text
+
+        Returns:
+            bool: True if cached
+        """
+        if generation is None:
+            return False
+        key = cls._key(userid, zipcode)
+        indexes = cls._indexes(userid, products)
+        keys = [key] + [cls._generation_key(index) for index in indexes] + indexes
+        try:
+            return bool(RedisHandle.client().eval(
+                cls._set_script, len(keys), *keys,
+                text, settings.INVENTORY_CACHE_TTL, len(indexes), *generation
+            ))
+        except Exception:
+            logger.exception(f"{cls.__name__} : set {userid}-{zipcode}")
+            return False
+
+    @classmethod
+    def _invalidate(cls, indexes):
+        try:
+            client = RedisHandle.client()
+            pipe = client.pipeline()
+            for index in indexes:
+                # text read before this point is not cached any more
+                pipe.incr(cls._generation_key(index))
+                pipe.expire(cls._generation_key(index), settings.INVENTORY_CACHE_TTL)
+                pipe.smembers(index)
+            keys = set()
+            for members in pipe.execute()[2::3]:
+                keys.update(members)
+            if keys:
+                client.delete(*keys)
+        except Exception:
+            logger.exception(f"{cls.__name__} : invalidate {indexes}")
+
+    @classmethod
+    def invalidate_user(cls, userid):
+        """Invalidate all zipcodes cached for the user
+        """
+        cls._invalidate([cls._user_index(userid)])
+
+    @classmethod
+    def invalidate_quantity(cls, info):
+        """Invalidate entries tracking any product of the quantity rows
+
+        Args:
+            info (list): rows of (sku, quantity, store, store_id)
+        """
+        indexes = {cls._product_index(store, sku) for sku, _, store, _ in info}
+        if indexes:
+            cls._invalidate(indexes)
+
+    @classmethod
+    def _claim(cls, key, ttl):
+        try:
+            return bool(RedisHandle.client().set(key, 1, nx=True, ex=ttl))
+        except Exception:
+            logger.exception(f"{cls.__name__} : claim {key}")
+            return True
+
+    @classmethod
+    def claim_refresh(cls, store, sku, zipcode, ttl):
+        """Claim background refresh of a product around zipcode for ttl seconds,
+        so that polling clients and preloads do not enqueue the same refresh again
+
+        Returns:
+            bool: True if claimed or Redis failed
+        """
+        return cls._claim(f"inventory:refresh:{store}:{sku}:{zipcode}", ttl)
+
+    @classmethod
+    def claim_preload(cls, userid, ttl):
+        """Claim preload of a user for ttl seconds, so that page reloads and
+        multiple tabs within the window do not preload again
+
+        Returns:
+            bool: True if claimed or Redis failed
+        """
+        return cls._claim(f"inventory:preload:{userid}", ttl)
+
+    @classmethod
+    def mark_empty(cls, store, sku, zipcode, ttl):
+        """Remember for ttl seconds that no store around zipcode has the product
+        """
+        try:
+            RedisHandle.client().set(f"inventory:empty:{store}:{sku}:{zipcode}", 1, ex=ttl)
+        except Exception:
+            logger.exception(f"{cls.__name__} : mark_empty {store}-{sku}-{zipcode}")
+
+    @classmethod
+    def mark_fetched(cls, store, sku, zipcode, ttl):
+        """Remember for ttl seconds that quantity of a product around zipcode
+        was downloaded, even if fewer stores than wanted have it
+        """
+        try:
+            RedisHandle.client().set(f"inventory:fetched:{store}:{sku}:{zipcode}", 1, ex=ttl)
+        except Exception:
+            logger.exception(f"{cls.__name__} : mark_fetched {store}-{sku}-{zipcode}")
+
+    @classmethod
+    def is_fetched(cls, store, sku, zipcode):
+        """
+
+        Returns:
+            bool: True if quantity was recently downloaded, False if not or
+                Redis failed
+        """
+        try:
+            return bool(RedisHandle.client().exists(f"inventory:fetched:{store}:{sku}:{zipcode}"))
+        except Exception:
+            logger.exception(f"{cls.__name__} : is_fetched {store}-{sku}-{zipcode}")
+            return False
+
+    @classmethod
+    def is_empty(cls, store, sku, zipcode):
+        """
+
+        Returns:
+            bool: True if recently confirmed that no store around zipcode has
+                the product, False if not or Redis failed
+        """
+        try:
+            return bool(RedisHandle.client().exists(f"inventory:empty:{store}:{sku}:{zipcode}"))
+        except Exception:
+            logger.exception(f"{cls.__name__} : is_empty {store}-{sku}-{zipcode}")
+            return False
+
+
+class StoreIndex:
+    """In-process GeoIndex of product_stores keyed by (store, store_id)
+
+    Loaded once per process on first use, e.g. at worker start. Stores added by
+    this process are indexed at once, and a version counter in Redis tells
+    other processes to reload, checked at most every STORE_INDEX_CHECK seconds.
+    """
+
+    _index = GeoIndex()
+    _lock = threading.Lock()
+    _version = None
+    _checked = None
+
+    _version_key = "stores:version"
+
+    @classmethod
+    def _remote_version(cls):
+        try:
+            value = RedisHandle.client().get(cls._version_key)
+        except Exception:
+            logger.exception(f"{cls.__name__} : version")
+            return None
+        return int(value) if value is not None else 0
+
+    @classmethod
+    def refresh(cls, force=False):
+        """Load all stores if not loaded yet or changed by another process
+
+        Returns:
+            bool: True if index is loaded
+        """
+        now = time.monotonic()
+        if not force and cls._checked is not None and now - cls._checked < settings.STORE_INDEX_CHECK:
+            return True
+        with cls._lock:
+            if not force and cls._checked is not None and now - cls._checked < settings.STORE_INDEX_CHECK:
+                return True
+            version = cls._remote_version()
+            if force or cls._checked is None or version != cls._version:
+                rows = ProductMySQLInterface.list_store_locations()
+                if rows is None:
+                    return cls._checked is not None
+                cls._index.load(((store, store_id), lat, long) for store, store_id, lat, long in rows)
+                cls._version = version
+                logger.debug(f"{cls.__name__} : {len(cls._index)} stores loaded")
+            cls._checked = now
+        return True
+
+    @classmethod
+    def add(cls, rows):
+        """Index stores just inserted, and tell other processes to reload
+
+        Args:
+            rows (list): (store, store_id, latitude, longitude)
+        """
+        if not rows:
+            return
+        cls._index.add(((store, store_id), lat, long) for store, store_id, lat, long in rows)
+        try:
+            version = RedisHandle.client().incr(cls._version_key)
+        except Exception:
+            logger.exception(f"{cls.__name__} : add")
+            return
+        with cls._lock:
+            # no other change in between, this process is up to date
+            if cls._version is not None and version == cls._version + 1:
+                cls._version = version
+
+    @classmethod
+    def unknown(cls, rows):
+        """Stores not indexed yet, e.g. found by an upstream lookup
+
+        Args:
+            rows (list): (store, store_id, latitude, longitude)
+
+        Returns:
+            list: rows of stores not indexed
+        """
+        cls.refresh()
+        return [row for row in rows if (row[0], row[1]) not in cls._index]
+
+    @classmethod
+    def nearest(cls, latitude, longitude, k=None, keys=None, radius=None):
+        """Rank stores by distance, see GeoIndex.nearest
+
+        Returns:
+            list: ((store, store_id), miles) nearest first
+        """
+        cls.refresh()
+        return cls._index.nearest(latitude, longitude, k=k, keys=keys, radius=radius)
@@ -1,6 +1,7 @@
 """Data Module"""
 
 from product.utils import MySQLHandle
+import math
 from loguru import logger
 
 logger.add("logs/default.log")
@@ -38,7 +39,7 @@ class ProductDataInterface:
         pass
 
     @classmethod
-    def get_mapping_by_zipcode_store(cls, store, zipcode):
+    def list_missing_mappings(cls, stores, zipcode):
         pass
 
     @classmethod
@@ -49,10 +50,34 @@ class ProductDataInterface:
     def add_zipcode_stores_mapping(cls, data):
         pass
 
+    @classmethod
+    def add_zipcode_centroids(cls, data):
+        pass
+
+    @classmethod
+    def list_nearby_stores(cls, store, zipcode, radius, limit):
+        pass
+
+    @classmethod
+    def delete_nearby_mappings(cls, store, locations, radius):
+        pass
+
+    @classmethod
+    def get_zipcode_centroid(cls, zipcode):
+        pass
+
+    @classmethod
+    def list_store_locations(cls):
+        pass
+
     @classmethod
     def count_store_with_latest(cls, sku, store, zipcode):
         pass
 
+    @classmethod
+    def list_stale_track_products(cls, userid, zipcode, min_count):
+        pass
+
     @classmethod
     def list_store_by_store_zipcode(cls, store, zipcode):
         pass
@@ -69,6 +94,60 @@ class ProductDataInterface:
 class ProductMySQLInterface(ProductDataInterface):
     """Data interface for Scraper implemented with MySQL"""
 
+    # Queries over product_inventory drive from the few rows of one product or
+    # of the tracked products of one user, through inventory_sku_store_time
+    # and the (store, zipcode, store_id) mapping key, never from the whole
+    # table. test_data.py checks their EXPLAIN plans.
+
+    # count of stores around zipcode with the latest quantity of sku
+    _count_store_with_latest_query = """
+        SELECT count(got.store_id)
+        FROM product_zipcodestoresmapping need
+        INNER JOIN product_inventory got
+        ON got.sku = %s AND got.store = need.store AND got.store_id = need.store_id
+            AND got.check_time > DATE_SUB(NOW(6), INTERVAL 1 HOUR)
+        WHERE need.store = %s AND need.zipcode = %s
+    """
+
+    # GeoJSON features of stores around zipcode with tracked products of user
+    _list_all_inventory_query = """
+        SELECT json_arrayagg(
+            json_object(
+                'type', 'Feature',
+                'geometry', ST_AsGeoJSON(s.location),
+                'properties', json_object(
+                    'store', p.store,
+                    'store_id', p.store_id,
+                    'name', s.store_name,
+                    'address', CONCAT(s.address, ', ', s.city, ', ', s.state, ' ', s.zipcode),
+                    'total', p.total,
+                    'products', p.products
+                )
+            )
+        )
+        FROM
+        (
+            SELECT json_arrayagg(
+                json_object(
+                    'sku', q.sku,
+                    'name', t.name,
+                    'quantity', q.quantity,
+                    'check_time', q.check_time,
+                    'stale', CAST('false' AS JSON)
+                )
+            ) AS products, sum(q.quantity) AS total, q.store AS store, q.store_id AS store_id
+            FROM product_products t
+            INNER JOIN product_inventory q
+            ON q.sku = t.sku AND q.store = t.store
+            INNER JOIN product_zipcodestoresmapping need
+            ON need.store = q.store AND need.zipcode = %s AND need.store_id = q.store_id
+            WHERE t.userid = %s AND t.track = 1
+            GROUP BY q.store, q.store_id
+        ) p
+        INNER JOIN product_stores s
+        ON s.store = p.store AND s.store_id = p.store_id
+    """
+
     @classmethod
     def get_zipcode(cls, userid):
         with MySQLHandle() as db:
@@ -169,11 +248,26 @@ class ProductMySQLInterface(ProductDataInterface):
         return result
 
     @classmethod
-    def get_mapping_by_zipcode_store(cls, store, zipcode):
+    def list_missing_mappings(cls, stores, zipcode):
+        # stores without zipcode_stores_mapping around zipcode, in one query
+        stores = list(stores)
+        if not stores:
+            return []
         with MySQLHandle() as db:
             if db.conn:
-                query = "SELECT * FROM product_zipcodestoresmapping WHERE store = %s AND zipcode = %s"
-                result = db.run(query, (store, zipcode))
+                query = f"""
+                SELECT s.store
+                FROM
+                (
+                    {" UNION ALL ".join(["SELECT %s AS store"] * len(stores))}
+                ) s
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM product_zipcodestoresmapping m
+                    WHERE m.store = s.store AND m.zipcode = %s
+                )
+                """
+                result = db.run(query, (*stores, zipcode))
             else:
                 result = None
         return result
@@ -205,27 +299,143 @@ class ProductMySQLInterface(ProductDataInterface):
                 result = None
         return result
 
+    @classmethod
+    def add_zipcode_centroids(cls, data):
+        with MySQLHandle() as db:
+            if db.conn:
+                query = (
+                    "INSERT INTO product_zipcodecentroids (zipcode, location) "
+                    "VALUES (%s, ST_PointFromText(%s, 4326)) "
+                    "ON DUPLICATE KEY UPDATE location=VALUES(location)"
+                )
+                data = [(zipcode, f"POINT({latitude} {longitude})") for zipcode, latitude, longitude in data]
+                result = db.run(query, data, commit=True, many=True)
+            else:
+                result = None
+        return result
+
+    @classmethod
+    def get_zipcode_centroid(cls, zipcode):
+        with MySQLHandle() as db:
+            if db.conn:
+                query = (
+                    "SELECT ST_Latitude(location), ST_Longitude(location) "
+                    "FROM product_zipcodecentroids WHERE zipcode = %s"
+                )
+                result = db.run(query, (zipcode,))
+            else:
+                result = None
+        return result
+
+    @classmethod
+    def list_store_locations(cls):
+        with MySQLHandle() as db:
+            if db.conn:
+                query = "SELECT store, store_id, ST_Latitude(location), ST_Longitude(location) FROM product_stores"
+                result = db.run(query, ())
+            else:
+                result = None
+        return result
+
+    @classmethod
+    def list_nearby_stores(cls, store, zipcode, radius, limit):
+        # (store_id, miles) of at most limit stores within radius miles of the
+        # centroid of zipcode, nearest first, empty if centroid is unknown
+        with MySQLHandle() as db:
+            if db.conn:
+                query = (
+                    "SELECT ST_Latitude(location), ST_Longitude(location) "
+                    "FROM product_zipcodecentroids WHERE zipcode = %s"
+                )
+                result = db.run(query, (zipcode,))
+                if result:
+                    box = cls._bounding_box(*result[0], radius)
+                    query = """
+                        SELECT s.store_id, ST_Distance_Sphere(s.location, z.location) / 1609.344 AS miles
+                        FROM product_stores s
+                        INNER JOIN product_zipcodecentroids z
+                        ON z.zipcode = %s
+                        WHERE s.store = %s AND ST_Within(s.location, ST_GeomFromText(%s, 4326))
+                        HAVING miles <= %s
+                        ORDER BY miles
+                        LIMIT %s
+                    """
+                    # 92128, tgt
+                    result = db.run(query, (zipcode, store, box, radius, limit))
+                elif result is not None:
+                    result = []
+            else:
+                result = None
+        return result
+
+    @classmethod
+    def delete_nearby_mappings(cls, store, locations, radius):
+        # forget zipcode_stores_mapping of store for zipcodes whose centroid is
+        # within radius miles of any (latitude, longitude), to be mapped again
+        with MySQLHandle() as db:
+            if db.conn:
+                query = """
+                    DELETE m
+                    FROM product_zipcodestoresmapping m
+                    INNER JOIN product_zipcodecentroids z
+                    ON z.zipcode = m.zipcode
+                    WHERE m.store = %s
+                    AND ST_Within(z.location, ST_GeomFromText(%s, 4326))
+                    AND ST_Distance_Sphere(z.location, ST_PointFromText(%s, 4326)) <= %s
+                """
+                data = [
+                    (store, cls._bounding_box(latitude, longitude, radius),
+                     f"POINT({latitude} {longitude})", radius * 1609.344)
+                    for latitude, longitude in locations
+                ]
+                result = db.run(query, data, commit=True, many=True)
+            else:
+                result = None
+        return result
+
+    @staticmethod
+    def _bounding_box(latitude, longitude, radius):
+        # WKT polygon around a point covering radius miles, searched with
+        # SPATIAL INDEX before filtering by distance
+        delta_lat = radius / 69.0
+        delta_long = min(radius / (69.0 * max(math.cos(math.radians(latitude)), 0.01)), 179.0)
+        south, north = max(latitude - delta_lat, -90.0), min(latitude + delta_lat, 90.0)
+        west, east = max(longitude - delta_long, -180.0), min(longitude + delta_long, 180.0)
+        return (
+            f"POLYGON(({south} {west}, {north} {west}, {north} {east}, "
+            f"{south} {east}, {south} {west}))"
+        )
+
     @classmethod
     def count_store_with_latest(cls, sku, store, zipcode):
         with MySQLHandle() as db:
             if db.conn:
+                # 81911643, tgt, 92128
+                result = db.run(cls._count_store_with_latest_query, (sku, store, zipcode))
+            else:
+                result = None
+        return result
+
+    @classmethod
+    def list_stale_track_products(cls, userid, zipcode, min_count):
+        with MySQLHandle() as db:
+            if db.conn:
+                # (sku, store, count of stores with the latest quantity) of tracked
+                # products having less than min_count such stores around zipcode
                 query = """
-                    SELECT count(got.store_id)
-                    FROM
-                    (
-                        SELECT store_id
-                        FROM product_inventory
-                        WHERE sku = %s AND store = %s AND check_time > DATE_SUB(NOW(6), INTERVAL 1 HOUR)
-                    ) got
-                    INNER JOIN
-                    (
-                        SELECT store_id
-                        FROM product_zipcodestoresmapping
-                        WHERE store = %s AND zipcode = %s 
-                    ) need
-                    ON got.store_id = need.store_id
+                    SELECT p.sku, p.store, count(got.store_id)
+                    FROM product_products p
+                    LEFT JOIN product_zipcodestoresmapping need
+                    ON need.store = p.store AND need.zipcode = %s
+                    LEFT JOIN product_inventory got
+                    ON got.sku = p.sku AND got.store = p.store AND got.store_id = need.store_id
+                        AND got.check_time > DATE_SUB(NOW(6), INTERVAL 1 HOUR)
+                    WHERE p.userid = %s AND p.track = 1
+                    GROUP BY p.sku, p.store
+                    HAVING count(got.store_id) < %s
                 """
-                result = db.run(query, (sku, store, store, zipcode))
+                # 92128, 51589605, 18
+                result = db.run(query, (zipcode, userid, min_count))
             else:
                 result = None
         return result
@@ -261,61 +471,8 @@ class ProductMySQLInterface(ProductDataInterface):
     def list_all_inventory(cls, userid, zipcode):
         with MySQLHandle() as db:
             if db.conn:
-                query = """
-                    SELECT json_arrayagg(
-                        json_object(
-                            'type', 'Feature',
-                            'geometry', s.location,
-                            'properties', json_object(
-                                'store', p.store,
-                                'name', s.store_name,
-                                'address', s.address,
-                                'total', p.total,
-                                'products', p.products
-                            )
-                        )
-                    )
-                    FROM
-                    (
-                        SELECT json_arrayagg(
-                            json_object(
-                                'sku', q.sku,
-                                'name', p.name,
-                                'quantity', q.quantity
-                            )
-                        ) AS products, sum(q.quantity) AS total, q.store AS store, q.store_id AS store_id
-                        FROM
-                        (
-                            SELECT sku, quantity, store, store_id
-                            FROM product_inventory
-                        ) q
-                        INNER JOIN
-                        (
-                            SELECT sku, name, store
-                            FROM product_products
-                            WHERE userid = %s AND track = 1
-                        ) p
-                        ON q.sku = p.sku AND q.store = p.store
-                        INNER JOIN
-                        (
-                            SELECT store, store_id
-                            FROM product_zipcodestoresmapping
-                            WHERE zipcode = %s 
-                        ) need
-                        ON q.store = need.store AND q.store_id = need.store_id
-                        GROUP BY q.store, q.store_id
-                    ) p
-                    INNER JOIN
-                    (
-                        SELECT store, store_id, store_name, 
-                            CONCAT(address, ', ', city, ', ', state, ' ', zipcode) AS address,
-                            ST_AsGeoJSON(location) AS location
-                        FROM product_stores
-                    ) s
-                    ON p.store = s.store AND p.store_id = s.store_id
-                """
-                # 51589605, 92128
-                result = db.run(query, (userid, zipcode))
+                # 92128, 51589605
+                result = db.run(cls._list_all_inventory_query, (zipcode, userid))
             else:
                 result = None
         return result
@@ -0,0 +1,46 @@
+"""Load zipcode centroids used to find nearby stores without upstream lookup"""
+
+from django.core.management.base import BaseCommand, CommandError
+from product.data import ProductMySQLInterface
+import csv
+
+
+class Command(BaseCommand):
+    help = (
+        "Load zipcode centroids from a Census Gazetteer ZCTA file, e.g. "
+        "2020_Gaz_zcta_national.txt, tab-separated with GEOID, INTPTLAT and INTPTLONG."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Gazetteer ZCTA file")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        total = 0
+        batch = []
+        with open(options["path"], newline="") as f:
+            reader = csv.reader(f, delimiter="\t")
+            header = [name.strip() for name in next(reader)]
+            try:
+                zipcode_col = header.index("GEOID")
+                lat_col, long_col = header.index("INTPTLAT"), header.index("INTPTLONG")
+            except ValueError:
+                raise CommandError("GEOID, INTPTLAT or INTPTLONG column not found.")
+            for row in reader:
+                zipcode = row[zipcode_col].strip()
+                if not zipcode.isdigit() or len(zipcode) != 5:
+                    continue
+                batch.append((zipcode, float(row[lat_col]), float(row[long_col])))
+                if len(batch) >= options["batch_size"]:
+                    total += self._save(batch)
+                    batch = []
+        total += self._save(batch)
+        self.stdout.write(self.style.SUCCESS(f"Loaded {total} zipcode centroids."))
+
+    @staticmethod
+    def _save(batch):
+        if not batch:
+            return 0
+        if not ProductMySQLInterface.add_zipcode_centroids(batch):
+            raise CommandError("Failed to save zipcode centroids.")
+        return len(batch)
@@ -0,0 +1,43 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+def restrict_location_srid(apps, schema_editor):
+    # MySQL only uses a spatial index of a column restricted to one SRID, which
+    # the POINT column created by Django is not. Rebuild the index after that.
+    if schema_editor.connection.vendor != "mysql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        constraints = schema_editor.connection.introspection.get_constraints(cursor, "product_stores")
+    for name, info in constraints.items():
+        if info["columns"] == ["location"] and info["index"]:
+            schema_editor.execute(f"DROP INDEX `{name}` ON product_stores")
+    schema_editor.execute("ALTER TABLE product_stores MODIFY location POINT NOT NULL SRID 4326")
+    schema_editor.execute("CREATE SPATIAL INDEX product_stores_location_id ON product_stores (location)")
+    schema_editor.execute("ALTER TABLE product_zipcodecentroids MODIFY location POINT NOT NULL SRID 4326")
+
+
+def unrestrict_location_srid(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute("DROP INDEX product_stores_location_id ON product_stores")
+    schema_editor.execute("ALTER TABLE product_stores MODIFY location POINT NOT NULL")
+    schema_editor.execute("CREATE SPATIAL INDEX product_stores_location_id ON product_stores (location)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZipcodeCentroids',
+            fields=[
+                ('zipcode', models.CharField(max_length=5, primary_key=True, serialize=False)),
+                ('location', django.contrib.gis.db.models.fields.PointField(spatial_index=False, srid=4326)),
+            ],
+        ),
+        migrations.RunPython(restrict_location_srid, unrestrict_location_srid),
+    ]
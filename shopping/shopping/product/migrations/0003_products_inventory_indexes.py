@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0002_zipcodecentroids_stores_spatial_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='products',
+            index=models.Index(fields=['userid', 'track', 'sku', 'store'], name='products_user_track'),
+        ),
+        migrations.AddIndex(
+            model_name='inventory',
+            index=models.Index(fields=['sku', 'store', 'check_time', 'store_id', 'quantity'], name='inventory_sku_store_time'),
+        ),
+    ]
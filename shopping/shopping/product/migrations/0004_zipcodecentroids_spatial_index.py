@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+def add_location_index(apps, schema_editor):
+    # zipcodes around newly found stores are searched by centroid, the column
+    # is already restricted to SRID 4326 by 0002
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute(
+        "CREATE SPATIAL INDEX product_zipcodecentroids_location_id ON product_zipcodecentroids (location)"
+    )
+
+
+def remove_location_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute("DROP INDEX product_zipcodecentroids_location_id ON product_zipcodecentroids")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0003_products_inventory_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_location_index, remove_location_index),
+    ]
@@ -11,7 +11,8 @@ from datetime import datetime
 #     name varchar(64) NOT NULL,
 #     store char(3) NOT NULL,
 #     track int NOT NULL DEFAULT 1,
-#     PRIMARY KEY (userid, sku, store)
+#     PRIMARY KEY (userid, sku, store),
+#     INDEX products_user_track (userid, track, sku, store)
 # );
 class Products(models.Model):
     userid = models.IntegerField()
@@ -27,6 +28,13 @@ class Products(models.Model):
                 name="unique_userid_sku_store"
             )
         ]
+        # tracked products of a user drive inventory queries
+        indexes = [
+            models.Index(
+                fields=["userid", "track", "sku", "store"],
+                name="products_user_track"
+            )
+        ]
 
 
 # CREATE TABLE zipcodes
@@ -48,7 +56,8 @@ class Zipcodes(models.Model):
 #     store char(3) NOT NULL,
 #     store_id varchar(8) NOT NULL,
 #     check_time datetime NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-#     PRIMARY KEY (sku, store, store_id)
+#     PRIMARY KEY (sku, store, store_id),
+#     INDEX inventory_sku_store_time (sku, store, check_time, store_id, quantity)
 # );
 class Inventory(models.Model):
     sku = models.CharField(max_length=15)
@@ -64,6 +73,13 @@ class Inventory(models.Model):
                 name="unique_sku_store_storeID"
             )
         ]
+        # covering index for latest quantity of a product at stores
+        indexes = [
+            models.Index(
+                fields=["sku", "store", "check_time", "store_id", "quantity"],
+                name="inventory_sku_store_time"
+            )
+        ]
 
 
 # Create directly in MySQL
@@ -101,7 +117,8 @@ class ZipcodeStoresMapping(models.Model):
 #     state varchar(24) NOT NULL,
 #     zipcode char(5) NOT NULL,
 #     location POINT NOT NULL SRID 4326,
-#     PRIMARY KEY (store, store_id)
+#     PRIMARY KEY (store, store_id),
+#     SPATIAL INDEX (location)
 # );
 class Stores(models.Model):
     store = models.CharField(max_length=3)
@@ -120,3 +137,18 @@ class Stores(models.Model):
                 name="unique_store_storeID"
             )
         ]
+
+
+# Create directly in MySQL
+# Centroids of zipcodes, e.g. loaded from Census Gazetteer ZCTA file
+# with "python manage.py load_zipcode_centroids <file>"
+# CREATE TABLE zipcode_centroids
+# (
+#     zipcode char(5) NOT NULL,
+#     location POINT NOT NULL SRID 4326,
+#     PRIMARY KEY (zipcode),
+#     SPATIAL INDEX (location)
+# );
+class ZipcodeCentroids(models.Model):
+    zipcode = models.CharField(max_length=5, primary_key=True)
+    location = PointField(spatial_index=False)
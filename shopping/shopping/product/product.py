@@ -1,9 +1,14 @@
 """Product Module"""
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from product.cache import InventoryCache, StoreIndex
 from product.data import ProductMySQLInterface
-from product.utils import StrAlnumSpaceConverter, Downloader
+from product.utils import StrAlnumSpaceConverter, AsyncDownloader, Downloader, FanOut, FastJsonResponse, SingleFlight
 from product import tasks
+import asyncio
 import json
+import weakref
 from loguru import logger
 
 
@@ -12,35 +17,48 @@ logger.add("logs/default.log")
 
 class Product:
     """Product base class"""
-    
+
+    # per event loop, shared by all requests of the process, caps concurrent
+    # quantity downloads
+    _quantity_limits = weakref.WeakKeyDictionary()
+    _store_fanout = FanOut(settings.INVENTORY_FETCH_WORKERS, "store")
+    # one upstream store lookup per (store, zipcode) across all processes
+    _store_flight = SingleFlight(
+        "store",
+        lock_ttl=settings.STORE_LOOKUP_DEADLINE * 2,
+        result_ttl=settings.QUANTITY_SINGLEFLIGHT_RESULT_TTL,
+        wait=settings.STORE_LOOKUP_DEADLINE
+    )
+
     @staticmethod
     def list_all_products(userid):
+        # JSON text as produced by MySQL, passed through to the response
         data = ProductMySQLInterface.list_all_products(userid)
         if data is None:
             return None
 
-        return json.loads(data[0][0]) if data and data[0][0] else []
+        return data[0][0] if data and data[0][0] else "[]"
 
     @staticmethod
     def update_product(userid, sku, store, track):
-        return ProductMySQLInterface.update_product(userid, sku, store, track)
+        result = ProductMySQLInterface.update_product(userid, sku, store, track)
+        if result:
+            InventoryCache.invalidate_user(userid)
+        return result
 
     @staticmethod
-    def search_product(store, keyword):
+    async def search_product_async(store, keyword):
         info = dict()
         if store == "tgt":
-            # PORTS: - 8001:8000 enables access 127.0.0.1:8001/X in
-            # browser. But inter-container communication uses 8000.
-            downloader = Downloader(
+            resp = await AsyncDownloader.get(
                 "http://scraper-web:8000/scraper/"
                 f"target/product/{keyword}/"
             )
-            resp = downloader.response
             if resp and resp.status_code == 200:
                 try:
                     info = resp.json().get("info")
                 except Exception:
-                    logger.exception(f"search_product : {keyword}")
+                    logger.exception(f"search_product_async : {keyword}")
                 if info is None:
                     info = dict()
         return info
@@ -48,7 +66,10 @@ class Product:
     @staticmethod
     def add_product(userid, sku, name, store):
         name = StrAlnumSpaceConverter(name).value
-        return ProductMySQLInterface.add_product(userid, sku, name, store)
+        result = ProductMySQLInterface.add_product(userid, sku, name, store)
+        if result:
+            InventoryCache.invalidate_user(userid)
+        return result
 
     @staticmethod
     def get_zipcode(userid):
@@ -57,20 +78,149 @@ class Product:
     @staticmethod
     def update_zipcode(userid, zipcode):
         # update zipcode asynchronously
-        tasks.update_zipcode.delay(userid, zipcode)
+        tasks.update_zipcode.apply_async((userid, zipcode), **tasks.lane_options("interactive"))
 
     @staticmethod
     def _delete_all_inventory(userid):
         ProductMySQLInterface.delete_all_inventory(userid)
 
     @staticmethod
-    def _get_quantity(count, sku, store, zipcode):
-        # get quantity synchronously and locally
-        info = tasks.get_quantity_from_store.run(count, sku, store, zipcode)
-        tasks.add_quantity_to_db.run(info)
+    async def _get_quantity_async(stale, zipcode):
+        # get quantity of stale (sku, store, count) concurrently, then write
+        # all at once. Return (sku, store) not downloaded in time.
+        if not stale:
+            return []
+        futures = {
+            asyncio.ensure_future(
+                Product._download_quantity_async(count, sku, store, zipcode)
+            ): (sku, store)
+            for sku, store, count in stale
+        }
+        done, pending = await asyncio.wait(futures, timeout=settings.INVENTORY_FETCH_DEADLINE)
+        info = []
+        missing = []
+        for future, key in futures.items():
+            if future in pending:
+                # save late quantity for next request
+                future.add_done_callback(Product._save_late_quantity)
+                missing.append(key)
+            elif future.exception() is not None:
+                logger.opt(exception=future.exception()).error(f"_get_quantity_async : {key}")
+                missing.append(key)
+            else:
+                info.extend(future.result())
+        await sync_to_async(tasks.add_quantity_to_db.run, thread_sensitive=False)(info)
+        return missing
+
+    @staticmethod
+    def _save_late_quantity(future):
+        if not future.cancelled() and future.exception() is None:
+            asyncio.get_running_loop().run_in_executor(None, tasks.add_quantity_to_db.run, future.result())
+
+    @staticmethod
+    def _quantity_limit():
+        loop = asyncio.get_running_loop()
+        semaphore = Product._quantity_limits.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(settings.INVENTORY_FETCH_WORKERS)
+            Product._quantity_limits[loop] = semaphore
+        return semaphore
+
+    @staticmethod
+    async def _download_quantity_async(count, sku, store, zipcode):
+        # wait for a scraper token no longer than the response deadline, then
+        # download on an executor thread so identical downloads of other
+        # requests are waited for instead of repeated
+        if not await sync_to_async(tasks.needs_download, thread_sensitive=False)(count, sku, store, zipcode):
+            return []
+        async with Product._quantity_limit():
+            if not await tasks.scraper_bucket.wait_async(settings.INVENTORY_FETCH_DEADLINE):
+                raise TimeoutError(f"Rate limited : {sku}-{zipcode}")
+            return await sync_to_async(tasks.download_quantity, thread_sensitive=False)(
+                count, sku, store, zipcode
+            )
+
+    @staticmethod
+    def _refresh_quantity(stale, zipcode):
+        # refresh quantity of stale (sku, store, count) in background, skip
+        # products not worth asking, just downloaded but still short of stores,
+        # or already being refreshed. Return (sku, store) being refreshed.
+        stale = [
+            (sku, store, count) for sku, store, count in stale
+            if tasks.needs_download(count, sku, store, zipcode)
+            and not InventoryCache.is_fetched(store, sku, zipcode)
+        ]
+        for sku, store, _ in stale:
+            if InventoryCache.claim_refresh(store, sku, zipcode, settings.INVENTORY_REFRESH_LEASE):
+                tasks.count_get_add_quantity.apply_async(
+                    (sku, store, zipcode, "interactive"), **tasks.lane_options("interactive")
+                )
+        return [(sku, store) for sku, store, _ in stale]
+
+    @staticmethod
+    def _sort_by_distance(text, zipcode):
+        # order stores of GeoJSON text by distance to zipcode, nearest first,
+        # and add "distance" in miles. Return text as is if zipcode is unknown.
+        centroid = ProductMySQLInterface.get_zipcode_centroid(zipcode)
+        if not centroid:
+            return text
+        stores = json.loads(text)
+        keys = [
+            (feature["properties"].get("store"), feature["properties"].get("store_id"))
+            for feature in stores
+        ]
+        distance = dict(StoreIndex.nearest(*centroid[0], keys=keys))
+        for feature, key in zip(stores, keys):
+            miles = distance.get(key)
+            feature["properties"]["distance"] = round(miles, 1) if miles is not None else None
+        # unknown stores last
+        stores.sort(key=lambda feature: (
+            feature["properties"]["distance"] is None, feature["properties"]["distance"] or 0
+        ))
+        return FastJsonResponse.dumps(stores).decode("utf-8")
+
+    @staticmethod
+    def _mark_stale(stores, missing):
+        # flag products whose quantity could not be refreshed in time
+        missing = set(missing)
+        for feature in stores:
+            properties = feature.get("properties", dict())
+            store = properties.get("store")
+            for product in properties.get("products") or []:
+                product["stale"] = (product.get("sku"), store) in missing
+
+    @staticmethod
+    def _map_nearby_stores(stores, zipcode):
+        # map zipcode to known stores within radius of its centroid, when as
+        # many as an upstream lookup returns are known. Return stores not mapped.
+        # Mappings are dropped when stores nearby are found later, see _get_store_info.
+        missing = []
+        for store in stores:
+            nearby = ProductMySQLInterface.list_nearby_stores(
+                store, zipcode, settings.STORE_RADIUS_MILES, settings.STORE_NEARBY_COUNT
+            )
+            if nearby and len(nearby) == settings.STORE_NEARBY_COUNT:
+                data = [(store, zipcode, store_id) for store_id, _ in nearby]
+                if ProductMySQLInterface.add_zipcode_stores_mapping(data):
+                    continue
+            missing.append(store)
+        return missing
+
+    @staticmethod
+    def _get_stores_info(stores, zipcode):
+        # look up stores around zipcode for retailers concurrently, identical
+        # lookups of other requests are waited for instead of repeated
+        calls = {
+            store: (Product._store_flight.do, (f"{store}:{zipcode}", Product._get_store_info, store, zipcode))
+            for store in stores
+        }
+        _, missing = Product._store_fanout.run(calls, timeout=settings.STORE_LOOKUP_DEADLINE)
+        if missing:
+            logger.warning(f"get_stores_info : {missing} around {zipcode} not ready")
 
     @staticmethod
     def _get_store_info(store, zipcode):
+        # Return count of stores found, None if lookup failed
         print(f"Getting store info for {store} around {zipcode} ...")
         if store == "tgt":
             store_info = None
@@ -88,49 +238,108 @@ class Product:
                     store_info = dict()
             if store_info is None:
                 return
-            ProductMySQLInterface.add_stores(store_info)
+            rows = [(item[0], item[1], item[7], item[8]) for item in store_info]
+            new = StoreIndex.unknown(rows)
+            if ProductMySQLInterface.add_stores(store_info):
+                StoreIndex.add(rows)
+                # zipcodes mapped nearby before these stores were known map again
+                if new:
+                    ProductMySQLInterface.delete_nearby_mappings(
+                        store, [(lat, long) for _, _, lat, long in new], settings.STORE_RADIUS_MILES
+                    )
             if len(store_info) == 20:
                 data = []
                 for item in store_info:
                     store_id = item[1]
                     data.append((store, zipcode, store_id))
                 ProductMySQLInterface.add_zipcode_stores_mapping(data)
+            return len(store_info)
 
     @staticmethod
-    def list_all_inventory(userid, zipcode):
+    def _prepare_inventory(userid, zipcode):
+        # Return tracked products and stale (sku, store, count), None on error
         data = ProductMySQLInterface.list_all_track_products(userid)
         if data is None:
             return None
 
         products = json.loads(data[0][0]) if data and data[0][0] else []
 
-        # get store info ready
-        stores_to_check = set()
-        for product in products:
-            store = product.get("store")
-            stores_to_check.add(store)
-        for store in stores_to_check:
-            # zipcode_stores_mapping not existing
-            if not ProductMySQLInterface.get_mapping_by_zipcode_store(store, zipcode):
-                Product._get_store_info(store, zipcode)
-
-        # get inventory ready
-        for product in products:
-            sku = product.get("sku")
-            store = product.get("store")
-            # count of stores with the latest quantity
-            count = 0
-            data = ProductMySQLInterface.count_store_with_latest(sku, store, zipcode)
-            if data:
-                count = data[0][0]
-            Product._get_quantity(count, sku, store, zipcode)
-
-        data = ProductMySQLInterface.list_all_inventory(userid, zipcode)
-        if data is None:
+        # get store info ready, only for stores without zipcode_stores_mapping
+        stores_to_check = {product.get("store") for product in products}
+        missing = ProductMySQLInterface.list_missing_mappings(stores_to_check, zipcode)
+        if missing:
+            missing = Product._map_nearby_stores([store for store, in missing], zipcode)
+        if missing:
+            Product._get_stores_info(missing, zipcode)
+
+        # get inventory ready, only for products without enough latest quantity
+        stale = ProductMySQLInterface.list_stale_track_products(
+            userid, zipcode, settings.INVENTORY_FRESH_STORE_COUNT
+        )
+        return products, stale or []
+
+    @staticmethod
+    def _finish_inventory(userid, zipcode, products, missing):
+        # Return (GeoJSON text, missing). The text produced by MySQL or cached
+        # flags every product not stale and is passed through, only parsed
+        # again to flag products missing.
+        text = InventoryCache.get(userid, zipcode)
+        if text is None:
+            generation = InventoryCache.generation(userid, products)
+            data = ProductMySQLInterface.list_all_inventory(userid, zipcode)
+            if data is None:
+                return None
+            text = Product._sort_by_distance(data[0][0], zipcode) if data and data[0][0] else ""
+            InventoryCache.set(userid, zipcode, text, products, generation)
+        if missing and text:
+            stores = json.loads(text)
+            Product._mark_stale(stores, missing)
+            text = FastJsonResponse.dumps(stores).decode("utf-8")
+        return text or "[]", missing
+
+    @staticmethod
+    async def list_all_inventory_async(userid, zipcode, revalidate=False):
+        # When revalidate is True, return current inventory without waiting
+        # for stale products, which are refreshed in background instead.
+        # Blocking MySQL/Redis/Celery calls run on executor threads with
+        # pooled connections.
+        prepared = await sync_to_async(Product._prepare_inventory, thread_sensitive=False)(userid, zipcode)
+        if prepared is None:
             return None
-        return json.loads(data[0][0]) if data and data[0][0] else []
+
+        products, stale = prepared
+        if not stale:
+            missing = []
+        elif revalidate:
+            missing = await sync_to_async(Product._refresh_quantity, thread_sensitive=False)(stale, zipcode)
+        else:
+            missing = await Product._get_quantity_async(stale, zipcode)
+        return await sync_to_async(Product._finish_inventory, thread_sensitive=False)(
+            userid, zipcode, products, missing
+        )
+
+    @staticmethod
+    def get_stats():
+        stats = dict()
+        try:
+            stats["singleflight"] = {
+                "quantity": tasks.quantity_flight.stats(),
+                "store": Product._store_flight.stats(),
+            }
+        except Exception:
+            logger.exception("get_stats : singleflight")
+        try:
+            stats["tasks"] = tasks.revoked_stats()
+        except Exception:
+            logger.exception("get_stats : tasks")
+        try:
+            stats["lanes"] = tasks.lane_stats()
+        except Exception:
+            logger.exception("get_stats : lanes")
+        return stats
 
     @staticmethod
     def preload(userid):
-        # refresh cache asynchronously
-        tasks.preload.delay(userid)
+        # refresh cache asynchronously, at most once per debounce window
+        if InventoryCache.claim_preload(userid, settings.PRELOAD_DEBOUNCE):
+            tasks.preload.apply_async((userid,), **tasks.lane_options("background"))
@@ -216,11 +216,15 @@ const inventory = createApp({
             })
         },
         list() {
+            this.listInventory(0)
+        },
+        listInventory(attempt) {
             fetch('/shopping/api/list_inventory/', {
                 mode: 'same-origin',
                 method: 'post',
                 body: JSON.stringify({
-                    'zipcode': this.zipcode
+                    'zipcode': this.zipcode,
+                    'mode': 'swr'
                 }),
                 headers: {
                     'content-type': 'application/json',
@@ -233,6 +237,10 @@ const inventory = createApp({
                     this.stores = json.stores,
                     this.message = json.message,
                     this.updateMap()
+                    // poll while stale inventory is refreshed in background
+                    if (json.refreshing && attempt < 10) {
+                        setTimeout(() => this.listInventory(attempt + 1), 2000)
+                    }
                 } else {
                     location.href = 'http://127.0.0.1:8080/account/'
                 }
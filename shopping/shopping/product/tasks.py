@@ -1,56 +1,197 @@
+from product.cache import InventoryCache
 from product.data import ProductMySQLInterface
-from product.utils import Downloader
+from product.utils import BloomSet, Downloader, RedisHandle, SingleFlight, TokenBucket
 from celery import shared_task, chain
+from celery.exceptions import Ignore, SoftTimeLimitExceeded
+from celery.signals import before_task_publish, task_prerun, task_revoked
 from celery.utils.log import get_task_logger
-from datetime import datetime, timedelta
-import json
-from time import sleep
+from django.conf import settings
+from time import monotonic, time
 
 logger = get_task_logger(__name__)
 
+# lock outlives a leader killed at the hard time limit of
+# get_quantity_from_store, and a Downloader in web processes, which
+# gives up within 3 tries of 3 seconds plus backoff
+quantity_flight = SingleFlight(
+    "quantity",
+    lock_ttl=30,
+    result_ttl=settings.QUANTITY_SINGLEFLIGHT_RESULT_TTL,
+    wait=settings.QUANTITY_SINGLEFLIGHT_WAIT
+)
+
+# paces calls to the scraper across web processes and Celery workers
+scraper_bucket = TokenBucket(
+    "scraper",
+    settings.SCRAPER_RATE_LIMIT["rate"],
+    settings.SCRAPER_RATE_LIMIT["burst"]
+)
+
+# SKUs unknown upstream, recorded by the scraper
+invalid_skus = BloomSet(
+    "tgt:sku",
+    settings.INVALID_SKUS["capacity"],
+    settings.INVALID_SKUS["error_rate"],
+    settings.INVALID_SKUS["check"]
+)
+
+
+@task_revoked.connect
+def count_revoked(sender=None, expired=None, **kwargs):
+    # count messages dropped by workers, by reason and task
+    reason = "expired" if expired else "revoked"
+    name = getattr(sender, "name", "unknown")
+    try:
+        RedisHandle.client().hincrby(f"celery:stats:{reason}", name, 1)
+    except Exception:
+        logger.exception(f"count_revoked : {reason} {name}")
+
+
+def lane_options(lane):
+    # apply_async options routing a task to a lane
+    return {"queue": lane}
+
+
+@before_task_publish.connect
+def stamp_enqueued(headers=None, routing_key=None, **kwargs):
+    # read back by workers as task.request.enqueued_at/lane
+    if headers is not None:
+        headers["enqueued_at"] = time()
+        headers["lane"] = routing_key
+
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    # per-lane count, total and bucketed histogram of seconds spent in queue
+    enqueued_at = task.request.get("enqueued_at")
+    lane = task.request.get("lane")
+    if enqueued_at is None or lane is None:
+        return
+    wait = max(time() - enqueued_at, 0)
+    bucket = next((f"le_{b}" for b in (0.1, 0.5, 1, 5, 30) if wait <= b), "le_inf")
+    try:
+        pipe = RedisHandle.client().pipeline()
+        pipe.hincrby(f"celery:wait:{lane}", "count", 1)
+        pipe.hincrbyfloat(f"celery:wait:{lane}", "seconds", wait)
+        pipe.hincrby(f"celery:wait:{lane}", bucket, 1)
+        pipe.execute()
+    except Exception:
+        logger.exception(f"record_queue_wait : {lane}")
+
+
+def lane_stats():
+    client = RedisHandle.client()
+    stats = dict()
+    for lane in settings.PRODUCT_LANES:
+        data = {
+            field.decode("utf-8"): float(value)
+            for field, value in client.hgetall(f"celery:wait:{lane}").items()
+        }
+        if data.get("count"):
+            data["average"] = data["seconds"] / data["count"]
+        stats[lane] = data
+    return stats
+
+
+def revoked_stats():
+    client = RedisHandle.client()
+    return {
+        reason: {
+            name.decode("utf-8"): int(count)
+            for name, count in client.hgetall(f"celery:stats:{reason}").items()
+        }
+        for reason in ("expired", "revoked")
+    }
+
 
 @shared_task(
     # bound to self instance
     bind=True,
-    # in-queue expiry time: in 1 hour
+    # in-queue expiry time, relative to sending
     utc=True,
-    expires=datetime.utcnow() + timedelta(hours=1),
-    # (soft, hard) execution time limits
-    # SoftTimeLimitExceeded exception is raised when
-    # soft time limit is reached.
-    timelimit=(25, 30),
+    expires=settings.PRODUCT_TASK_EXPIRES["get_quantity_from_store"],
+    # execution time limits, SoftTimeLimitExceeded
+    # exception is raised when soft time limit is reached
+    soft_time_limit=25,
+    time_limit=30,
     # retry with max_retries and backoff
     autoretry_for=(Exception,),
     max_retries=5,
     retry_backoff=True,
-    # select queue
-    queue="slow",
+    # select lane, interactive callers override
+    queue="background",
 )
-def get_quantity_from_store(self, count, sku, store, zipcode):
+def get_quantity_from_store(self, count, sku, store, zipcode, reschedules=0):
     logger.info(f"Get quantity for {sku} at {store} around {zipcode}")
-    sleep(0.5)
+    if needs_download(count, sku, store, zipcode):
+        # no token, free the worker slot and come back when one is due.
+        # Re-sent with its own count, not retry(), so that reschedules do not
+        # use up the retries left for errors.
+        delay = scraper_bucket.acquire()
+        if delay > 0:
+            if reschedules >= settings.SCRAPER_RATE_LIMIT["reschedules"]:
+                logger.warning(f"Rate limited, give up {sku} at {store} around {zipcode}")
+                return []
+            self.signature_from_request(
+                kwargs={**self.request.kwargs, "reschedules": reschedules + 1}, countdown=delay
+            ).apply_async()
+            raise Ignore()
+    return download_quantity(count, sku, store, zipcode)
+
+
+def needs_download(count, sku, store, zipcode):
+    # count of stores with the latest quantity is not enough, and the scraper
+    # has neither found the SKU unknown nor recently found no store with it
+    return (
+        store == "tgt"
+        and count < settings.INVENTORY_FRESH_STORE_COUNT
+        and sku not in invalid_skus
+        and not InventoryCache.is_empty(store, sku, zipcode)
+    )
+
+
+def download_quantity(count, sku, store, zipcode):
+    """Download quantity of sku at stores around zipcode from scraper, unless
+    count of stores with the latest quantity is already enough
+    """
     info = []
-    # variation exists, not always 20
-    if store == "tgt" and count < 18:
-        downloader = Downloader(
-            "http://scraper-web:8000/scraper/"
-            f"target/quantity/{sku}/{zipcode}/"
-        )
-        resp = downloader.response
-        if resp and resp.status_code == 200:
-            try:
-                info = resp.json().get("info")
-            except Exception:
-                logger.exception(f"get_quantity_from_store : {sku}-{zipcode}")
-            if info is None:
-                info = []
+    if needs_download(count, sku, store, zipcode):
+        # identical downloads in flight elsewhere are waited for, not repeated
+        info = quantity_flight.do(f"{store}:{sku}:{zipcode}", _download_quantity, sku, zipcode)
+    return info
+
+
+def _download_quantity(sku, zipcode):
+    downloader = Downloader(
+        "http://scraper-web:8000/scraper/"
+        f"target/quantity/{sku}/{zipcode}/"
+    )
+    return _read_quantity(downloader.response, sku, zipcode)
+
+
+def _read_quantity(resp, sku, zipcode):
+    # quantity rows of a scraper response, remembering that no store nearby
+    # has the product. SKUs unknown upstream are recorded by the scraper.
+    info = []
+    if resp is not None and resp.status_code == 200:
+        try:
+            data = resp.json()
+            info = data.get("info")
+            if data.get("empty"):
+                InventoryCache.mark_empty("tgt", sku, zipcode, settings.INVENTORY_EMPTY_TTL)
+            elif info is not None:
+                InventoryCache.mark_fetched("tgt", sku, zipcode, settings.INVENTORY_REFRESH_LEASE)
+        except Exception:
+            logger.exception(f"download_quantity : {sku}-{zipcode}")
+        if info is None:
+            info = []
     return info
 
 
 @shared_task(
-    # in-queue expiry time: in 1 hour
+    # in-queue expiry time, relative to sending
     utc=True,
-    expires=datetime.utcnow() + timedelta(hours=1),
+    expires=settings.PRODUCT_TASK_EXPIRES["add_quantity_to_db"],
     # (soft, hard) execution time limits
     # SoftTimeLimitExceeded exception is raised when
     # soft time limit is reached.
@@ -58,17 +199,18 @@ def get_quantity_from_store(self, count, sku, store, zipcode):
     # acknowledge after execution for idempotent
     # procedures
     acks_late=True,
-    # select queue
-    queue="celery",
+    # select lane, interactive callers override
+    queue="background",
 )
 def add_quantity_to_db(info):
     if info:
-        ProductMySQLInterface.add_quantity(info)
+        if ProductMySQLInterface.add_quantity(info):
+            InventoryCache.invalidate_quantity(info)
 
 
 @shared_task(
     utc=True,
-    expires=datetime.utcnow() + timedelta(minutes=5),
+    expires=settings.PRODUCT_TASK_EXPIRES["count_quantity"],
     timelimit=(25, 30),
     acks_late=True,
 )
@@ -83,69 +225,119 @@ def count_quantity(sku, store, zipcode):
 
 @shared_task(
     utc=True,
-    expires=datetime.utcnow() + timedelta(minutes=5),
+    expires=settings.PRODUCT_TASK_EXPIRES["count_get_add_quantity"],
     timelimit=(25, 30),
     acks_late=True,
-    queue="fast",
+    queue="background",
 )
-def count_get_add_quantity(sku, store, zipcode):
+def count_get_add_quantity(sku, store, zipcode, lane="background"):
+    # every step stays in the lane of the caller
+    options = lane_options(lane)
     chain(
-        count_quantity.s(sku, store, zipcode),
-        get_quantity_from_store.s(sku, store, zipcode),
-        add_quantity_to_db.s()
+        count_quantity.s(sku, store, zipcode).set(**options),
+        get_quantity_from_store.s(sku, store, zipcode).set(**options),
+        add_quantity_to_db.s().set(**options)
     ).delay()
 
 
+def stream_quantities(skus, zipcode):
+    """Download quantity of many SKUs at Target stores around zipcode in one
+    streaming request, remembering products no store nearby has
+
+    Yields:
+        tuple: (sku, quantity rows or None, error message or None) of each SKU
+            as soon as its download completes. SKUs not yielded have failed.
+    """
+    for line in Downloader.iter_lines(
+        "http://scraper-web:8000/scraper/"
+        f"target/quantity/stream/?zipcode={zipcode}&skus={','.join(skus)}",
+        settings.PRELOAD_LINE_TIMEOUT
+    ):
+        sku, rows, error = line.get("sku"), line.get("info"), line.get("error")
+        if error is None and not rows:
+            # confirmed, no store nearby has it
+            InventoryCache.mark_empty("tgt", sku, zipcode, settings.INVENTORY_EMPTY_TTL)
+        yield sku, rows, error
+
+
 @shared_task(
     utc=True,
-    expires=datetime.utcnow() + timedelta(minutes=5),
-    timelimit=(25, 30),
+    expires=settings.PRODUCT_TASK_EXPIRES["preload"],
+    soft_time_limit=55,
+    time_limit=60,
     acks_late=True,
+    queue="background",
 )
-def get_tracked_products(userid):
+def preload(userid):
+    # one freshness query, batched downloads of stale products, one bulk upsert
     zipcode = ""
-    products = []
     data = ProductMySQLInterface.get_zipcode(userid)
     if data:
         zipcode = data[0][0]
-    if zipcode:
-        data = ProductMySQLInterface.list_all_track_products(userid)
-        if data:
-            products = json.loads(data[0][0])
-    return zipcode, products
+    if not zipcode:
+        return []
+    data = ProductMySQLInterface.list_stale_track_products(
+        userid, zipcode, settings.INVENTORY_FRESH_STORE_COUNT
+    )
+    # skip products not worth asking
+    stale = [(sku, store) for sku, store, count in data or [] if needs_download(count, sku, store, zipcode)]
 
-
-@shared_task(
-    utc=True,
-    expires=datetime.utcnow() + timedelta(minutes=5),
-    timelimit=(25, 30),
-    acks_late=True,
-)
-def get_quantity_per_product(zipcode_products):
-    zipcode, products = zipcode_products
-    for product in products:
-        sku = product["sku"]
-        store = product["store"]
-        count_get_add_quantity.delay(sku, store, zipcode)
+    info = []
+    timing = []
+    size = settings.PRELOAD_BATCH_SIZE
+    try:
+        _preload_batches(userid, zipcode, stale, size, info, timing)
+    except SoftTimeLimitExceeded:
+        logger.info(f"Preload {userid} around {zipcode} stopped at batch {len(timing)}: time limit")
+    add_quantity_to_db.run(info)
+    return timing
 
 
-@shared_task(
-    utc=True,
-    expires=datetime.utcnow() + timedelta(minutes=5),
-    timelimit=(25, 30),
-    acks_late=True,
-    queue="fast",
-)
-def preload(userid):
-    chain(
-        get_tracked_products.s(userid),
-        get_quantity_per_product.s()
-    ).delay()
+def _preload_batches(userid, zipcode, stale, size, info, timing):
+    # download stale (sku, store) in batches, collecting quantity rows in
+    # info, saving them as they grow, and per batch timing in timing
+    for i in range(0, len(stale), size):
+        if not scraper_bucket.wait(settings.PRELOAD_TOKEN_WAIT):
+            logger.info(f"Preload {userid} around {zipcode} stopped at batch {i // size}: rate limited")
+            break
+        # claim right before downloading, so that products of batches not
+        # reached are left to polling clients, skip those already being refreshed
+        batch = [
+            sku for sku, store in stale[i:i + size]
+            if InventoryCache.claim_refresh(store, sku, zipcode, settings.INVENTORY_REFRESH_LEASE)
+        ]
+        if not batch:
+            continue
+        start = monotonic()
+        rows = done = 0
+        first = None
+        for _, quantity, error in stream_quantities(batch, zipcode):
+            if first is None:
+                first = monotonic() - start
+            if error is not None:
+                continue
+            done += 1
+            rows += len(quantity)
+            info.extend(quantity)
+            # save while the scraper keeps downloading the rest
+            if len(info) >= settings.PRELOAD_UPSERT_ROWS:
+                add_quantity_to_db.run(info)
+                info.clear()
+        elapsed = monotonic() - start
+        errors = len(batch) - done
+        timing.append({
+            "skus": len(batch), "rows": rows, "errors": errors,
+            "first": round(first, 3) if first is not None else None, "seconds": round(elapsed, 3)
+        })
+        logger.info(
+            f"Preload {userid} around {zipcode} batch {i // size}: "
+            f"{len(batch)} products, {rows} rows, {errors} errors in {elapsed:.3f}s"
+        )
 
 
 @shared_task(
     utc=True,
-    expires=datetime.utcnow() + timedelta(minutes=5),
+    expires=settings.PRODUCT_TASK_EXPIRES["update_zipcode"],
     timelimit=(25, 30),
     acks_late=True,
 )
@@ -0,0 +1,84 @@
+"""
+EXPLAIN based regression tests of inventory queries, run against MySQL only
+Command line: python -m pytest ./test_data.py
+"""
+
+from django.db import connection
+from product.data import ProductMySQLInterface
+import pytest
+
+
+pytestmark = pytest.mark.django_db
+
+USERID = 51589605
+ZIPCODE = "92128"
+SKUS = 2000
+STORES = 40
+TRACKED = 10
+
+
+@pytest.fixture
+def inventory():
+    if connection.vendor != "mysql":
+        pytest.skip("EXPLAIN plans are MySQL specific")
+
+    store_ids = [str(10000 + i) for i in range(STORES)]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO product_products (userid, sku, name, store, track) VALUES (%s, %s, %s, %s, %s)",
+            [(USERID + user, str(10000000 + sku), "name", "tgt", 1) for user in range(5) for sku in range(TRACKED)]
+        )
+        cursor.executemany(
+            "INSERT INTO product_inventory (sku, quantity, store, store_id, check_time) VALUES (%s, %s, %s, %s, NOW(6))",
+            [(str(10000000 + sku), sku % 7, "tgt", store_id) for sku in range(SKUS) for store_id in store_ids]
+        )
+        cursor.executemany(
+            "INSERT INTO product_zipcodestoresmapping (store, zipcode, store_id) VALUES (%s, %s, %s)",
+            [("tgt", str(92100 + zipcode), store_id) for zipcode in range(40) for store_id in store_ids[:20]]
+        )
+        cursor.executemany(
+            "INSERT INTO product_stores (store, store_id, store_name, address, city, state, zipcode, location) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, ST_GeomFromText('POINT(%s %s)', 4326))",
+            [("tgt", store_id, "name", "address", "city", "CA", ZIPCODE, 32.9, -117.1) for store_id in store_ids]
+        )
+        for table in ("product_products", "product_inventory", "product_zipcodestoresmapping", "product_stores"):
+            cursor.execute(f"ANALYZE TABLE {table}")
+
+
+def explain(query, params):
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN " + query, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def assert_no_full_scan(plan, tables):
+    for row in plan:
+        if row["table"] in tables:
+            assert row["type"] != "ALL", row
+            assert row["key"] is not None, row
+            # rows of one product or one store, never the whole table
+            assert row["rows"] <= STORES * TRACKED, row
+
+
+def test_count_store_with_latest(inventory):
+    plan = explain(ProductMySQLInterface._count_store_with_latest_query, ("10000001", "tgt", ZIPCODE))
+    assert_no_full_scan(plan, {"need", "got"})
+    rows = {row["table"]: row for row in plan}
+    assert rows["got"]["key"] == "inventory_sku_store_time", rows["got"]
+    assert rows["got"]["rows"] <= STORES, rows["got"]
+
+
+def test_list_all_inventory(inventory):
+    plan = explain(ProductMySQLInterface._list_all_inventory_query, (ZIPCODE, USERID))
+    assert_no_full_scan(plan, {"t", "q", "need", "s"})
+    rows = {row["table"]: row for row in plan}
+    # driven from the tracked products of the user
+    joined = [row["table"] for row in plan if row["table"] in {"t", "q", "need"}]
+    assert joined[0] == "t", plan
+    assert rows["t"]["key"] == "products_user_track", rows["t"]
+    assert rows["t"]["rows"] <= TRACKED, rows["t"]
+    # then the stores of each product, each checked against the mapping key
+    assert rows["q"]["key"] == "inventory_sku_store_time", rows["q"]
+    assert rows["q"]["rows"] <= STORES, rows["q"]
+    assert rows["need"]["rows"] == 1, rows["need"]
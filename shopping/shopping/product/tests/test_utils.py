@@ -1,10 +1,18 @@
 """
-Tests for Converter classes
-Command line: python -m pytest ./test_valueconverter.py
+Tests for product.utils: converters, MySQL pool, FanOut, Downloader,
+FastJsonResponse, GeoIndex, Bloom filters, SingleFlight and TokenBucket
+Command line: python -m pytest ./test_utils.py
 """
 
+import decimal
+import fakeredis
+import http.server
+import json
 import pytest
-from product.utils import IntConverter, StrAlnumConverter
+import threading
+import time
+from product import utils
+from product.utils import IntConverter, StrAlnumConverter, MySQLPool, FanOut, Downloader, FastJsonResponse, RawJSON, GeoIndex, BloomFilter, BloomSet, SingleFlight, TokenBucket
 
 
 class TestIntConverter:
@@ -171,3 +179,315 @@ class TestStrAlnumConverter:
         handle = StrAlnumConverter()
         result = handle.convert(input_val)
         assert result == output_val
+
+
+class FakeConnection:
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.closed = False
+        self.rollbacks = 0
+
+    def ping(self):
+        if not self.alive:
+            raise Exception("MySQL server has gone away")
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestMySQLPool:
+    @pytest.fixture
+    def connections(self, monkeypatch):
+        opened = []
+
+        def connect(**kwargs):
+            conn = FakeConnection()
+            opened.append(conn)
+            return conn
+
+        monkeypatch.setattr(utils.MySQLdb, "connect", connect)
+        return opened
+
+    def test_reuse_ok(self, connections):
+        pool = MySQLPool("host", "user", "passwd", "db", min_size=1, max_size=2, max_idle=300, timeout=0.1)
+        conn = pool.acquire()
+        pool.release(conn)
+        assert pool.acquire() is conn
+        assert len(connections) == 1
+        assert conn.rollbacks == 1
+
+    def test_max_size_timeout(self, connections):
+        pool = MySQLPool("host", "user", "passwd", "db", min_size=1, max_size=1, max_idle=300, timeout=0.1)
+        pool.acquire()
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+
+    def test_stale_connection_replaced(self, connections):
+        pool = MySQLPool("host", "user", "passwd", "db", min_size=1, max_size=1, max_idle=300, timeout=0.1)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.alive = False
+        assert pool.acquire() is not conn
+        assert conn.closed
+        assert len(connections) == 2
+
+    def test_broken_connection_closed(self, connections):
+        pool = MySQLPool("host", "user", "passwd", "db", min_size=1, max_size=1, max_idle=300, timeout=0.1)
+        conn = pool.acquire()
+        pool.release(conn, broken=True)
+        assert conn.closed
+        assert pool.acquire() is not conn
+
+    def test_idle_reaped(self, connections):
+        pool = MySQLPool("host", "user", "passwd", "db", min_size=1, max_size=3, max_idle=0, timeout=0.1)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        pool.acquire()
+        assert first.closed
+        assert not second.closed
+
+
+class TestFanOut:
+    def test_run_ok(self):
+        fanout = FanOut(4)
+        results, missing = fanout.run({key: (pow, (key, 2)) for key in range(10)}, timeout=5)
+        assert results == {key: key ** 2 for key in range(10)}
+        assert missing == []
+
+    def test_error_missing(self):
+        fanout = FanOut(2)
+        results, missing = fanout.run({"ok": (int, ("1",)), "error": (int, ("a",))}, timeout=5)
+        assert results == {"ok": 1}
+        assert missing == ["error"]
+
+    def test_deadline_abandoned(self):
+        fanout = FanOut(2)
+        release = threading.Event()
+        late = []
+        finished = threading.Event()
+
+        def on_late(key, result):
+            late.append((key, result))
+            finished.set()
+
+        results, missing = fanout.run(
+            {"fast": (int, ("1",)), "slow": (release.wait, (5,))},
+            timeout=0.2,
+            on_late=on_late
+        )
+        assert results == {"fast": 1}
+        assert missing == ["slow"]
+        release.set()
+        assert finished.wait(5)
+        assert late == [("slow", True)]
+
+
+class TestDownloaderSession:
+    def test_reuse_per_thread(self):
+        session = Downloader._session()
+        assert Downloader._session() is session
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(Downloader._session()))
+        thread.start()
+        thread.join()
+        assert other[0] is not session
+        assert other[0].get_adapter("http://") is session.get_adapter("http://")
+
+
+class TestDownloaderStream:
+    @pytest.fixture
+    def server(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path == "/ok" else 404)
+                self.end_headers()
+                self.wfile.write(b'{"sku": "1"}\n\n{"sku": "2"}\nnot json\n{"sku": "3"}\n')
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+        server.shutdown()
+        server.server_close()
+
+    def test_lines_until_error(self, server):
+        assert list(Downloader.iter_lines(f"{server}/ok", 3)) == [{"sku": "1"}, {"sku": "2"}]
+
+    def test_not_found(self, server):
+        assert list(Downloader.iter_lines(f"{server}/missing", 3)) == []
+
+
+class TestFastJson:
+    def test_dumps(self):
+        data = {"name": "caf\u00e9", "price": decimal.Decimal("1.50"), "ids": [1, 2]}
+        assert json.loads(FastJsonResponse.dumps(data)) == {"name": "caf\u00e9", "price": "1.50", "ids": [1, 2]}
+        with pytest.raises(TypeError):
+            FastJsonResponse.dumps({"x": object()})
+
+    def test_raw(self):
+        assert RawJSON('[{"sku": "1"}]').value == b'[{"sku": "1"}]'
+        assert RawJSON(b"[]").value == b"[]"
+        assert RawJSON(None).value == b"[]"
+        assert RawJSON("", default="{}").value == b"{}"
+
+
+class TestGeoIndex:
+    rows = [
+        (("tgt", "1"), 32.95, -117.06),
+        (("tgt", "2"), 34.05, -118.24),
+        (("tgt", "3"), 32.72, -117.16),
+    ]
+
+    @pytest.mark.parametrize("vectorized", [True, False])
+    def test_nearest(self, monkeypatch, vectorized):
+        if not vectorized:
+            monkeypatch.setattr(utils, "numpy", None)
+        elif utils.numpy is None:
+            pytest.skip("numpy not installed")
+        index = GeoIndex()
+        index.load(self.rows)
+        ranked = index.nearest(32.95, -117.06)
+        assert [key for key, _ in ranked] == [("tgt", "1"), ("tgt", "3"), ("tgt", "2")]
+        assert ranked[0][1] == pytest.approx(0, abs=1e-6)
+        # Rancho Bernardo to downtown Los Angeles is about 100 miles
+        assert 95 < ranked[2][1] < 110
+        assert [key for key, _ in index.nearest(32.95, -117.06, k=1)] == [("tgt", "1")]
+        assert [key for key, _ in index.nearest(32.95, -117.06, radius=50)] == [("tgt", "1"), ("tgt", "3")]
+        assert [key for key, _ in index.nearest(32.95, -117.06, keys=[("tgt", "2"), ("tgt", "9")])] == [("tgt", "2")]
+
+    def test_add(self):
+        index = GeoIndex()
+        index.load(self.rows[:1])
+        index.add([(("tgt", "1"), 34.05, -118.24), (("tgt", "4"), 32.72, -117.16)])
+        assert len(index) == 2
+        assert ("tgt", "4") in index
+        assert ("tgt", "2") not in index
+        assert [key for key, _ in index.nearest(32.72, -117.16)] == [("tgt", "4"), ("tgt", "1")]
+
+
+class TestBloomFilter:
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        skus = [str(10000000 + i) for i in range(1000)]
+        for sku in skus:
+            bloom.add(sku)
+        assert all(sku in bloom for sku in skus)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(str(10000000 + i))
+        false_positives = sum(str(20000000 + i) in bloom for i in range(10000))
+        assert false_positives < 300
+
+    def test_empty(self):
+        bloom = BloomFilter(10, 0.001)
+        assert "81911643" not in bloom
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(utils.RedisHandle, "_client", client)
+    return client
+
+
+class BrokenRedis:
+    def __getattr__(self, name):
+        raise ConnectionError("Redis is down")
+
+
+class TestSingleFlight:
+    def test_leader(self, redis_client):
+        flight = SingleFlight("test", wait=0.2)
+        calls = []
+        assert flight.do("key", lambda: calls.append(1) or {"qty": 1}) == {"qty": 1}
+        assert calls == [1]
+        assert flight.stats() == {"leader": 1}
+        assert not redis_client.exists("singleflight:test:key:lock")
+
+    def test_hit(self, redis_client):
+        flight = SingleFlight("test", wait=0.2)
+        flight.do("key", lambda: [1, 2])
+        assert flight.do("key", lambda: pytest.fail("result not reused")) == [1, 2]
+        assert flight.stats() == {"leader": 1, "hit": 1}
+
+    def test_coalesced(self, redis_client):
+        flight = SingleFlight("test", wait=5)
+        redis_client.set("singleflight:test:key:lock", "other")
+
+        def publish():
+            time.sleep(0.1)
+            redis_client.set("singleflight:test:key:result", json.dumps([3]))
+            redis_client.publish("singleflight:test:key", "done")
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+        assert flight.do("key", lambda: pytest.fail("call not coalesced")) == [3]
+        thread.join()
+        assert flight.stats() == {"coalesced": 1}
+
+    def test_fallback(self, redis_client):
+        flight = SingleFlight("test", wait=0.2)
+        redis_client.set("singleflight:test:key:lock", "other")
+        assert flight.do("key", lambda: [4]) == [4]
+        assert flight.stats() == {"fallback": 1}
+
+    def test_redis_down(self, monkeypatch):
+        monkeypatch.setattr(utils.RedisHandle, "_client", BrokenRedis())
+        assert SingleFlight("test").do("key", lambda: [5]) == [5]
+
+    def test_publish_error(self, redis_client, monkeypatch):
+        monkeypatch.setattr(redis_client, "pipeline", BrokenRedis)
+        assert SingleFlight("test").do("key", lambda: [6]) == [6]
+        assert not redis_client.exists("singleflight:test:key:lock")
+
+
+class TestBloomSet:
+    @staticmethod
+    def record(client, item, expiry):
+        # as the scraper does, a new item bumps the version
+        client.zadd("bloom:test:expiry", {item: expiry})
+        client.incr("bloom:test:version")
+
+    def test_reload_on_version(self, redis_client):
+        bloom = BloomSet("test", 100, 0.01, check=0)
+        self.record(redis_client, "1", time.time() + 60)
+        assert "1" in bloom
+        # one item expires as another arrives, same cardinality
+        redis_client.zadd("bloom:test:expiry", {"1": time.time() - 1})
+        self.record(redis_client, "2", time.time() + 60)
+        assert "2" in bloom
+        assert "1" not in bloom
+
+    def test_redis_down(self, monkeypatch):
+        monkeypatch.setattr(utils.RedisHandle, "_client", BrokenRedis())
+        assert "1" not in BloomSet("test", 100, 0.01, check=0)
+
+
+class TestTokenBucket:
+    def test_burst(self, redis_client):
+        bucket = TokenBucket("test", rate=1, burst=2)
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == 0
+        assert 0 < bucket.acquire() <= 1
+
+    def test_wait(self, redis_client):
+        bucket = TokenBucket("test", rate=20, burst=1)
+        assert bucket.wait(1)
+        assert bucket.wait(1)
+        slow = TokenBucket("slow", rate=0.1, burst=1)
+        assert slow.wait(1)
+        assert not slow.wait(1)
+
+    def test_redis_down(self, monkeypatch):
+        monkeypatch.setattr(utils.RedisHandle, "_client", BrokenRedis())
+        assert TokenBucket("test", rate=1, burst=1).acquire() == 0
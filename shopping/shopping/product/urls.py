@@ -12,5 +12,6 @@ urlpatterns = [
     path("api/update_product/", views.update_product),
     path("api/get_zipcode/", views.get_zipcode),
     path("api/list_inventory/", views.list_all_inventory),
+    path("api/stats/", views.get_stats),
     path("<str:jwt_token>/", views.show_home),
 ]
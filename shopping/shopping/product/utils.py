@@ -1,17 +1,244 @@
+from array import array
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
 import decimal
+from django.http import HttpResponse
+import hashlib
+import httpx
+import json
+import math
 import MySQLdb
 from loguru import logger
 import os
 import re
+import redis
 import requests
+import threading
+import time
 from urllib3 import Retry
+import uuid
+import weakref
+
+try:
+    import numpy
+except ImportError:
+    # optional, falls back to pure Python distance computation
+    numpy = None
+try:
+    import orjson
+except ImportError:
+    # optional, falls back to json
+    orjson = None
 
 logger.add("logs/default.log")
 
 
+class MySQLPool:
+    """Process-wide pool of persistent MySQL connections
+
+    One pool exists per (host, username, dbname) in each process, shared by all
+    threads. Connections are pinged on checkout, reaped when idle longer than
+    max_idle (keeping at least min_size), and forgotten after fork so that Celery
+    prefork children never share a socket with their parent.
+    """
+
+    _pools = dict()
+    _pools_lock = threading.Lock()
+
+    def __init__(
+            self,
+            host,
+            username,
+            password,
+            dbname,
+            min_size=int(os.environ.get("SQL_POOL_MIN_SIZE", "1")),
+            max_size=int(os.environ.get("SQL_POOL_MAX_SIZE", "10")),
+            max_idle=float(os.environ.get("SQL_POOL_MAX_IDLE", "300")),
+            timeout=float(os.environ.get("SQL_POOL_TIMEOUT", "5"))
+    ):
+        """
+
+        Args:
+            host (str): database host
+            username (str): database user
+            password (str): database password
+            dbname (str): database name
+            min_size (int, optional): connections kept when reaping. Defaults to SQL_POOL_MIN_SIZE or 1.
+            max_size (int, optional): maximum open connections. Defaults to SQL_POOL_MAX_SIZE or 10.
+            max_idle (float, optional): seconds before an idle connection is reaped. Defaults to
+                SQL_POOL_MAX_IDLE or 300.
+            timeout (float, optional): seconds to wait for a free connection. Defaults to
+                SQL_POOL_TIMEOUT or 5.
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.dbname = dbname
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        """Forget all connections, used on creation and in a forked child
+        """
+        # connections inherited from parent are kept referenced but never used,
+        # deallocating them would send COM_QUIT on the socket shared with parent
+        self._inherited = [conn for conn, _ in getattr(self, "_idle", [])]
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        # idle connections as (conn, released_at), most recently used at the end
+        self._idle = []
+        # number of connections checked out or idle
+        self._size = 0
+
+    @classmethod
+    def get(cls, host, username, password, dbname):
+        """Return the pool of current process for given database, create if not existing
+
+        Returns:
+            MySQLPool: pool
+        """
+        key = (host, username, dbname)
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls(host, username, password, dbname)
+                cls._pools[key] = pool
+        return pool
+
+    @classmethod
+    def _after_fork(cls):
+        """Reset locks and pools in a forked child, a lock held by another thread
+        at fork time would otherwise never be released
+        """
+        cls._pools_lock = threading.Lock()
+        for pool in cls._pools.values():
+            pool._reset()
+
+    def _check_fork(self):
+        """Drop connections inherited from parent process without closing them,
+        in case the process was not forked by os.fork
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _connect(self):
+        return MySQLdb.connect(
+            host=self.host,
+            user=self.username,
+            passwd=self.password,
+            db=self.dbname
+        )
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _reap(self, now):
+        """Close connections idle longer than max_idle, keeping at least min_size,
+        called with self._cond held
+        """
+        while self._idle and self._size > self.min_size:
+            conn, released_at = self._idle[0]
+            if now - released_at <= self.max_idle:
+                break
+            self._idle.pop(0)
+            self._size -= 1
+            self._close(conn)
+
+    def acquire(self):
+        """Check out a healthy connection, open a new one if none is idle and
+        max_size is not reached, otherwise wait at most timeout seconds
+
+        Returns:
+            MySQLdb.connections.Connection: connection
+        """
+        self._check_fork()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                self._reap(time.monotonic())
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"{type(self).__name__} : No connection available.")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                # reserve a slot before connecting outside the lock
+                else:
+                    self._size += 1
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._discard()
+                    raise
+            # health check on checkout
+            try:
+                conn.ping()
+            except Exception:
+                logger.debug(f"{type(self).__name__} : Stale connection dropped.")
+                self._close(conn)
+                self._discard()
+            else:
+                return conn
+
+    def release(self, conn, broken=False):
+        """Return connection to pool, close it if broken
+
+        Any open transaction is rolled back so that the next user does not read
+        from a stale snapshot.
+
+        Args:
+            conn (MySQLdb.connections.Connection): connection
+            broken (bool, optional): connection should not be reused. Defaults to False.
+        """
+        if self._pid != os.getpid():
+            return
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            self._close(conn)
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self):
+        """Free the slot of a connection that is closed or never opened
+        """
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def close(self):
+        """Close all idle connections
+        """
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close(conn)
+
+
+os.register_at_fork(after_in_child=MySQLPool._after_fork)
+
+
 class MySQLHandle:
     """MySQLHandle as context management
     Always check if self.conn is None (connection error, report internal error)
+    Connections are borrowed from the process-wide MySQLPool and returned on exit.
     """
 
     def __init__(
@@ -26,15 +253,12 @@ class MySQLHandle:
         self.password = password
         self.dbname = dbname
         self.conn = None
+        self._pool = MySQLPool.get(host, username, password, dbname)
+        self._broken = False
 
     def __enter__(self):
         try:
-            self.conn = MySQLdb.connect(
-                host=self.host,
-                user=self.username,
-                passwd=self.password,
-                db=self.dbname
-            )
+            self.conn = self._pool.acquire()
         except Exception:
             logger.exception(f"{type(self).__name__} : Connection to database failed.")
             # avoid ide warning, Exception will not be raised due to return in finally
@@ -69,6 +293,7 @@ class MySQLHandle:
                 result = cur.fetchall()
         except Exception:
             logger.exception(f"{type(self).__name__} : {query}")
+            self._broken = True
             # avoid ide warning, Exception will not be raised due to return in finally
             raise
         finally:
@@ -78,7 +303,367 @@ class MySQLHandle:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.conn:
-            self.conn.close()
+            self._pool.release(self.conn, broken=self._broken or exc_type is not None)
+            self.conn = None
+
+
+class RedisHandle:
+    """Process-wide Redis client for caching, separate from Celery result backend db
+
+    redis-py clients are thread-safe and their connection pools reset themselves
+    after fork, so one client per process is enough.
+    """
+
+    _client = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def client(cls):
+        """
+
+        Returns:
+            redis.Redis: client
+        """
+        if cls._client is None:
+            with cls._lock:
+                if cls._client is None:
+                    cls._client = redis.Redis(
+                        host=os.environ.get("REDIS_HOST"),
+                        port=int(os.environ.get("REDIS_PORT", "6379")),
+                        username=os.environ.get("REDIS_USER"),
+                        password=os.environ.get("REDIS_PASSWORD"),
+                        db=int(os.environ.get("REDIS_CACHE_DB", "1")),
+                        socket_timeout=1,
+                        socket_connect_timeout=1
+                    )
+        return cls._client
+
+
+class SingleFlight:
+    """Distributed singleflight backed by Redis
+
+    Identical calls, i.e. same name and key, running at the same time in any
+    thread or process are coalesced: the first caller takes a lock and runs the
+    call as leader, then publishes the JSON-serializable result, while other
+    callers wait for it instead of running the call again. A published result is
+    also reused by callers arriving within result_ttl seconds. Callers run the
+    call themselves if Redis fails or no result arrives within wait seconds.
+    Counters of leader/hit/coalesced/fallback are kept per name.
+    """
+
+    # delete lock only if still owned
+    _release_script = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+
+    def __init__(self, name, lock_ttl=30, result_ttl=5, wait=10):
+        """
+
+        Args:
+            name (str): namespace of keys and counters
+            lock_ttl (int, optional): seconds before lock of a dead leader expires. Defaults to 30.
+            result_ttl (int, optional): seconds a published result is reused. Defaults to 5.
+            wait (float, optional): seconds to wait for the leader. Defaults to 10.
+        """
+        self.name = name
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.wait = wait
+
+    def _count(self, client, field):
+        try:
+            client.hincrby(f"singleflight:stats:{self.name}", field, 1)
+        except Exception:
+            logger.debug(f"{type(self).__name__} : {self.name} {field}")
+
+    def stats(self):
+        """
+
+        Returns:
+            dict: counter -> count
+        """
+        data = RedisHandle.client().hgetall(f"singleflight:stats:{self.name}")
+        return {field.decode("utf-8"): int(count) for field, count in data.items()}
+
+    def do(self, key, func, *args):
+        """Run func(*args) once for all concurrent callers with the same key
+
+        Args:
+            key (str): key of identical calls
+            func (callable): call returning JSON-serializable result
+
+        Returns:
+            type: result of func
+        """
+        base = f"singleflight:{self.name}:{key}"
+        lock_key, result_key = f"{base}:lock", f"{base}:result"
+        try:
+            client = RedisHandle.client()
+            cached = client.get(result_key)
+            if cached is not None:
+                self._count(client, "hit")
+                return json.loads(cached)
+            token = uuid.uuid4().hex
+            leader = client.set(lock_key, token, nx=True, ex=self.lock_ttl)
+        except Exception:
+            logger.exception(f"{type(self).__name__} : {base}")
+            return func(*args)
+
+        if leader:
+            self._count(client, "leader")
+            try:
+                result = func(*args)
+                try:
+                    pipe = client.pipeline()
+                    pipe.set(result_key, json.dumps(result), ex=self.result_ttl)
+                    pipe.publish(base, "done")
+                    pipe.execute()
+                except Exception:
+                    # waiters fall back to running the call themselves
+                    logger.exception(f"{type(self).__name__} : {base}")
+                return result
+            finally:
+                try:
+                    client.eval(self._release_script, 1, lock_key, token)
+                except Exception:
+                    logger.exception(f"{type(self).__name__} : {base}")
+
+        result = self._wait_result(client, base, lock_key, result_key)
+        if result is not None:
+            self._count(client, "coalesced")
+            return json.loads(result)
+        self._count(client, "fallback")
+        return func(*args)
+
+    def _wait_result(self, client, channel, lock_key, result_key):
+        """Wait for result published by leader
+
+        Returns:
+            bytes/NoneType: published result, None if leader is gone or too slow
+        """
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            # subscribe before checking to not miss the notification
+            pubsub.subscribe(channel)
+            deadline = time.monotonic() + self.wait
+            while True:
+                result = client.get(result_key)
+                if result is not None:
+                    return result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not client.exists(lock_key):
+                    # leader may have published right before releasing lock
+                    return client.get(result_key)
+                pubsub.get_message(timeout=min(remaining, 1))
+        except Exception:
+            logger.exception(f"{type(self).__name__} : {channel}")
+            return None
+        finally:
+            pubsub.close()
+
+
+class TokenBucket:
+    """Distributed token bucket backed by Redis
+
+    All processes using the same name share one bucket refilled at rate tokens
+    per second up to burst tokens. Refill and take run atomically in Redis on
+    its own clock, so hosts with skewed clocks still agree. If Redis fails,
+    calls are allowed rather than blocked.
+    """
+
+    # return seconds to wait for next token, 0 if a token is taken
+    _take_script = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or burst
+        local ts = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, name, rate, burst):
+        """
+
+        Args:
+            name (str): key of bucket, e.g. retailer and endpoint
+            rate (float): tokens refilled per second
+            burst (int): maximum tokens
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def acquire(self):
+        """Take a token without waiting
+
+        Returns:
+            float: 0 if a token is taken, otherwise seconds until next token
+        """
+        try:
+            return float(RedisHandle.client().eval(
+                self._take_script, 1, f"ratelimit:{self.name}", self.rate, self.burst
+            ))
+        except Exception:
+            logger.exception(f"{type(self).__name__} : {self.name}")
+            return 0
+
+    def wait(self, timeout):
+        """Take a token, waiting at most timeout seconds
+
+        Returns:
+            bool: True if a token is taken
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            delay = self.acquire()
+            if delay <= 0:
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+
+    async def wait_async(self, timeout):
+        """Take a token like wait, sleeping without blocking the event loop
+
+        Returns:
+            bool: True if a token is taken
+        """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            delay = await loop.run_in_executor(None, self.acquire)
+            if delay <= 0:
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            await asyncio.sleep(delay)
+
+
+class BloomFilter:
+    """Compact set of items with false positives but no false negatives
+
+    Sized for capacity items at error_rate false positives. The bit positions
+    of an item are derived from one blake2b digest by double hashing, same as
+    the scraper, so both services agree on the same items.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+
+        Args:
+            capacity (int): expected number of items
+            error_rate (float): false positive rate at capacity, e.g. 0.001
+        """
+        self.size = max(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class BloomSet:
+    """Set of items known for a while, e.g. invalid SKUs, checked locally
+
+    Items are added by the scraper to a Redis sorted set scored by expiry
+    time, with a version counter bumped on each new item. Each process keeps a
+    BloomFilter of unexpired items, rebuilt on first use, e.g. at worker
+    start, and whenever the version changed, checked at most every check
+    seconds. The filter only rules items out: its hits are
+    confirmed in Redis, since they may be false positives or expired. If Redis
+    fails, items are not considered known.
+    """
+
+    def __init__(self, name, capacity, error_rate, check):
+        """
+
+        Args:
+            name (str): key of set
+            capacity (int): expected number of items, grown if exceeded
+            error_rate (float): false positive rate at capacity
+            check (float): seconds between checks whether the set changed
+        """
+        self.name = name
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.check = check
+        self._key = f"bloom:{name}:expiry"
+        self._version_key = f"bloom:{name}:version"
+        self._filter = BloomFilter(capacity, error_rate)
+        self._version = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Rebuild filter from all unexpired items persisted in Redis
+
+        Returns:
+            bool: True if loaded
+        """
+        try:
+            pipe = RedisHandle.client().pipeline()
+            pipe.get(self._version_key)
+            pipe.zrangebyscore(self._key, time.time(), "+inf")
+            version, members = pipe.execute()
+        except Exception:
+            logger.exception(f"{type(self).__name__} : load {self.name}")
+            self._checked = time.monotonic()
+            return False
+        bloom = BloomFilter(max(self.capacity, 2 * len(members)), self.error_rate)
+        for member in members:
+            bloom.add(member.decode("utf-8"))
+        with self._lock:
+            self._filter = bloom
+            self._version = int(version or 0)
+            self._checked = time.monotonic()
+        logger.debug(f"{type(self).__name__} : {len(members)} {self.name} loaded")
+        return True
+
+    def _refresh(self):
+        if self._checked is not None and time.monotonic() - self._checked < self.check:
+            return
+        try:
+            version = int(RedisHandle.client().get(self._version_key) or 0)
+        except Exception:
+            logger.exception(f"{type(self).__name__} : version {self.name}")
+            version = None
+        if version is not None and version != self._version:
+            self.load()
+        else:
+            self._checked = time.monotonic()
+
+    def __contains__(self, item):
+        self._refresh()
+        if item not in self._filter:
+            return False
+        try:
+            expiry = RedisHandle.client().zscore(self._key, item)
+        except Exception:
+            logger.exception(f"{type(self).__name__} : check {self.name} {item}")
+            return False
+        return expiry is not None and expiry > time.time()
 
 
 class ValueConverter:
@@ -297,7 +882,18 @@ class AutoAdapter(requests.adapters.HTTPAdapter):
 
 
 class Downloader:
-    """Downloader base class"""
+    """Downloader base class
+
+    Requests go through keep-alive sessions reused for the whole process. All
+    sessions of a process share one AutoAdapter, i.e. one connection pool per host
+    with at most HTTP_POOL_MAXSIZE connections, while each thread has its own
+    session since requests.Session is not thread-safe. Both are recreated after fork.
+    """
+
+    _pid = None
+    _adapter = None
+    _local = threading.local()
+    _lock = threading.Lock()
 
     def __init__(self, url):
         """
@@ -305,23 +901,393 @@ class Downloader:
         Args:
             url (str, optional): url. Defaults to None.
         """
-        # change with AutoAdapter(timeout=3, max_retries=3) if needed
-        self._adapter = AutoAdapter()
         self._url = url
         self.response = self._download()
 
+    @classmethod
+    def _session(cls):
+        """Return keep-alive session of current thread, create if not existing
+
+        Returns:
+            requests.Session: session
+        """
+        if cls._pid != os.getpid():
+            with cls._lock:
+                if cls._pid != os.getpid():
+                    # change with AutoAdapter(timeout=3, max_retries=3) if needed
+                    cls._adapter = AutoAdapter(
+                        pool_connections=int(os.environ.get("HTTP_POOL_CONNECTIONS", "10")),
+                        pool_maxsize=int(os.environ.get("HTTP_POOL_MAXSIZE", "10"))
+                    )
+                    cls._local = threading.local()
+                    cls._pid = os.getpid()
+        session = getattr(cls._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", cls._adapter)
+            session.mount("http://", cls._adapter)
+            cls._local.session = session
+        return session
+
     def _download(self):
         """Download and store response
         """
         rsp = None
         try:
-            with requests.Session() as session:
-                session.mount("https://", self._adapter)
-                session.mount("http://", self._adapter)
-                rsp = session.get(self._url)
+            rsp = self._session().get(self._url)
         except requests.exceptions.ConnectionError:
             logger.debug(f"{type(self).__name__} : {self._url}")
         except:
             logger.error(f"{type(self).__name__} : {self._url}")
         finally:
             return rsp
+
+    @classmethod
+    def iter_lines(cls, url, timeout):
+        """Download NDJSON from url as a stream and yield each line parsed as
+        soon as it arrives
+
+        The connection goes back to the pool once all lines are read or the
+        generator is closed. Download and parse errors are logged and end the
+        stream, so callers treat lines not received as failed.
+
+        Args:
+            url (str): url
+            timeout (float): seconds to wait for the next line
+
+        Yields:
+            type: parsed line
+        """
+        try:
+            with cls._session().get(url, stream=True, timeout=(3, timeout)) as rsp:
+                if rsp.status_code != 200:
+                    logger.debug(f"{cls.__name__} : {rsp.status_code} {url}")
+                    return
+                for line in rsp.iter_lines():
+                    if line:
+                        yield json.loads(line)
+        except requests.exceptions.RequestException:
+            logger.debug(f"{cls.__name__} : {url}")
+        except ValueError:
+            logger.exception(f"{cls.__name__} : {url}")
+
+
+class AsyncDownloader:
+    """Async counterpart of Downloader for async views
+
+    Each event loop has one pooled keep-alive httpx.AsyncClient. Timeout and
+    retry follow AutoAdapter: 3 seconds, at most 3 retries with backoff on
+    connection errors and 413/429/5xx, honoring Retry-After.
+    """
+
+    _clients = weakref.WeakKeyDictionary()
+
+    timeout = 3
+    retries = 3
+    backoff_factor = 0.5
+    status_forcelist = (413, 429, 500, 502, 503, 504)
+
+    @classmethod
+    def _client(cls):
+        """Return client of running event loop, create if not existing
+
+        Returns:
+            httpx.AsyncClient: client
+        """
+        loop = asyncio.get_running_loop()
+        client = cls._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=cls.timeout,
+                limits=httpx.Limits(
+                    max_connections=int(os.environ.get("HTTP_POOL_MAXSIZE", "10")),
+                    max_keepalive_connections=int(os.environ.get("HTTP_POOL_MAXSIZE", "10"))
+                )
+            )
+            cls._clients[loop] = client
+        return client
+
+    @classmethod
+    def _backoff(cls, attempt, rsp):
+        """Seconds to wait before retry attempt, Retry-After of response first
+        """
+        retry_after = rsp.headers.get("Retry-After") if rsp is not None else None
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return cls.backoff_factor * (2 ** (attempt - 1))
+
+    @classmethod
+    async def get(cls, url):
+        """Download url
+
+        Args:
+            url (str): url
+
+        Returns:
+            httpx.Response/NoneType: response, None if connection failed
+        """
+        rsp = None
+        for attempt in range(cls.retries + 1):
+            if attempt:
+                await asyncio.sleep(cls._backoff(attempt, rsp))
+            try:
+                rsp = await cls._client().get(url)
+            except httpx.TransportError:
+                logger.debug(f"{cls.__name__} : {url}")
+                rsp = None
+                continue
+            except Exception:
+                logger.error(f"{cls.__name__} : {url}")
+                return None
+            if rsp.status_code not in cls.status_forcelist:
+                break
+        return rsp
+
+
+class FanOut:
+    """Run independent calls concurrently on a shared bounded thread pool
+
+    The pool is created lazily per process and shared by all callers, so
+    max_workers caps concurrent calls of the whole process. Calls not finished
+    before the deadline are abandoned instead of awaited, they keep running in
+    background and their results are handed to on_late if given.
+    """
+
+    def __init__(self, max_workers, name="fanout"):
+        """
+
+        Args:
+            max_workers (int): maximum concurrent calls
+            name (str, optional): thread name prefix. Defaults to "fanout".
+        """
+        self.max_workers = max(max_workers, 1)
+        self.name = name
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """
+
+        Returns:
+            ThreadPoolExecutor: executor of current process
+        """
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=self.name
+                )
+                self._pid = os.getpid()
+        return self._executor
+
+    def run(self, calls, timeout=None, on_late=None):
+        """Run calls concurrently and wait at most timeout seconds
+
+        Args:
+            calls (dict): key -> (function, args)
+            timeout (float, optional): deadline in seconds. Defaults to None, no deadline.
+            on_late (callable, optional): called with (key, result) of calls finished
+                after the deadline. Defaults to None.
+
+        Returns:
+            tuple: (dict of key -> result, list of keys without result)
+        """
+        futures = {
+            self.executor.submit(func, *args): key
+            for key, (func, args) in calls.items()
+        }
+        done, not_done = wait(futures, timeout=timeout)
+
+        results = dict()
+        missing = []
+        for future in done:
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception:
+                logger.exception(f"{type(self).__name__} : {key}")
+                missing.append(key)
+        for future in not_done:
+            key = futures[future]
+            missing.append(key)
+            # not started yet, nobody is waiting for it anymore
+            if future.cancel():
+                continue
+            if on_late is not None:
+                future.add_done_callback(self._late_callback(key, on_late))
+        if not_done:
+            logger.debug(f"{type(self).__name__} : {len(not_done)} calls abandoned after {timeout}s.")
+        return results, missing
+
+    @staticmethod
+    def _late_callback(key, on_late):
+        def callback(future):
+            try:
+                on_late(key, future.result())
+            except Exception:
+                logger.exception(f"FanOut : {key}")
+        return callback
+
+
+class RawJSON:
+    """JSON text produced elsewhere, e.g. by MySQL, to be embedded in a
+    FastJsonResponse as is, without parsing and serializing it again
+    """
+
+    def __init__(self, text, default="[]"):
+        """
+
+        Args:
+            text (str/bytes/NoneType): JSON text
+            default (str, optional): JSON text used if text is empty. Defaults to "[]".
+        """
+        text = text or default
+        self.value = text if isinstance(text, bytes) else text.encode("utf-8")
+
+
+class FastJsonResponse(HttpResponse):
+    """JsonResponse serializing with orjson if installed, otherwise json
+
+    RawJSON values of the top-level dict are spliced into the response as is,
+    other values are serialized. Decimal is serialized as string like
+    DjangoJSONEncoder does.
+    """
+
+    def __init__(self, data, **kwargs):
+        """
+
+        Args:
+            data (dict): response data, values can be RawJSON
+        """
+        kwargs.setdefault("content_type", "application/json")
+        parts = [
+            self.dumps(key) + b":" + (value.value if isinstance(value, RawJSON) else self.dumps(value))
+            for key, value in data.items()
+        ]
+        super().__init__(content=b"{" + b",".join(parts) + b"}", **kwargs)
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, decimal.Decimal):
+            return str(obj)
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    @classmethod
+    def dumps(cls, obj):
+        """Serialize obj to JSON
+
+        Returns:
+            bytes: UTF-8 encoded JSON text
+        """
+        if orjson is not None:
+            return orjson.dumps(obj, default=cls._default)
+        return json.dumps(obj, default=cls._default, separators=(",", ":")).encode("utf-8")
+
+
+class GeoIndex:
+    """In-memory index of point locations for nearest-point ranking
+
+    Coordinates are kept as radians in array("d") columns, and haversine
+    distances to all points are computed at once with numpy if installed,
+    otherwise in pure Python. Each change builds new columns and swaps them in
+    at once, so readers never see a partial update and need no lock.
+    """
+
+    # mean radius of the earth in miles
+    radius = 3958.8
+
+    def __init__(self):
+        self._snapshot = (tuple(), dict(), array("d"), array("d"))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._snapshot[0])
+
+    def __contains__(self, key):
+        return key in self._snapshot[1]
+
+    def load(self, rows):
+        """Replace all points
+
+        Args:
+            rows (iterable): (key, latitude, longitude) in degrees
+        """
+        with self._lock:
+            self._snapshot = self._build(tuple(), array("d"), array("d"), rows)
+
+    def add(self, rows):
+        """Add points, or move points of existing keys
+
+        Args:
+            rows (iterable): (key, latitude, longitude) in degrees
+        """
+        with self._lock:
+            keys, _, lat, long = self._snapshot
+            self._snapshot = self._build(keys, array("d", lat), array("d", long), rows)
+
+    @staticmethod
+    def _build(keys, lat, long, rows):
+        keys = list(keys)
+        positions = {key: i for i, key in enumerate(keys)}
+        for key, latitude, longitude in rows:
+            i = positions.get(key)
+            if i is None:
+                positions[key] = len(keys)
+                keys.append(key)
+                lat.append(math.radians(float(latitude)))
+                long.append(math.radians(float(longitude)))
+            else:
+                lat[i] = math.radians(float(latitude))
+                long[i] = math.radians(float(longitude))
+        return tuple(keys), positions, lat, long
+
+    def nearest(self, latitude, longitude, k=None, keys=None, radius=None):
+        """Rank points by distance
+
+        Args:
+            latitude (float): latitude in degrees
+            longitude (float): longitude in degrees
+            k (int, optional): maximum points returned. Defaults to None, all.
+            keys (iterable, optional): only rank these keys. Defaults to None, all.
+            radius (float, optional): maximum miles. Defaults to None, no limit.
+
+        Returns:
+            list: (key, miles) nearest first, unknown keys are skipped
+        """
+        all_keys, positions, lat, long = self._snapshot
+        if keys is None:
+            rows = range(len(all_keys))
+        else:
+            rows = [positions[key] for key in keys if key in positions]
+        if not rows:
+            return []
+        lat0, long0 = math.radians(latitude), math.radians(longitude)
+        if numpy is not None:
+            index = numpy.asarray(rows)
+            lat1 = numpy.frombuffer(lat, dtype=numpy.float64)[index]
+            long1 = numpy.frombuffer(long, dtype=numpy.float64)[index]
+            a = (
+                numpy.sin((lat1 - lat0) / 2) ** 2
+                + math.cos(lat0) * numpy.cos(lat1) * numpy.sin((long1 - long0) / 2) ** 2
+            )
+            miles = 2 * self.radius * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+            order = numpy.argsort(miles, kind="stable")
+            if radius is not None:
+                order = order[miles[order] <= radius]
+            if k is not None:
+                order = order[:k]
+            return [(all_keys[rows[i]], float(miles[i])) for i in order]
+        cos_lat0 = math.cos(lat0)
+        ranked = []
+        for i in rows:
+            a = (
+                math.sin((lat[i] - lat0) / 2) ** 2
+                + cos_lat0 * math.cos(lat[i]) * math.sin((long[i] - long0) / 2) ** 2
+            )
+            ranked.append((all_keys[i], 2 * self.radius * math.asin(math.sqrt(min(a, 1.0)))))
+        ranked.sort(key=lambda item: item[1])
+        if radius is not None:
+            ranked = [item for item in ranked if item[1] <= radius]
+        return ranked[:k] if k is not None else ranked
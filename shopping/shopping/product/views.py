@@ -1,7 +1,8 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import JsonResponse
 from django.shortcuts import render, redirect
 from product.product import Product
+from product.utils import FastJsonResponse, RawJSON
 from loguru import logger
 import json
 import jwt
@@ -46,20 +47,20 @@ def show_home(request, jwt_token=""):
 def list_all_products(request):
     userid = get_userid(request)
     if userid == 0:
-        return JsonResponse({"authenticated": False, "products": [], "message": "Not authenticated."})
+        return FastJsonResponse({"authenticated": False, "products": [], "message": "Not authenticated."})
 
     msg = ""
     info = Product.list_all_products(userid)
     if info is None:
         msg = "Server error."
-        info = []
-    return JsonResponse({"authenticated": True, "products": info, "message": msg})
+        info = "[]"
+    return FastJsonResponse({"authenticated": True, "products": RawJSON(info), "message": msg})
 
 
 def update_product(request):
     userid = get_userid(request)
     if userid == 0:
-        return JsonResponse({"authenticated": False, "message": "Not authenticated."})
+        return FastJsonResponse({"authenticated": False, "message": "Not authenticated."})
 
     data = json.loads(request.body).get("product")
     sku, store, track = data.get("sku"), data.get("store").lower(), int(data.get("track"))
@@ -70,17 +71,18 @@ def update_product(request):
         msg = "Update succeeded."
     else:
         msg = "Update failed."
-    return JsonResponse({"authenticated": True, "message": msg})
+    return FastJsonResponse({"authenticated": True, "message": msg})
 
 
-def search_product(request):
-    userid = get_userid(request)
+async def search_product(request):
+    # session may hit the database, keep it off the event loop
+    userid = await sync_to_async(get_userid)(request)
     if userid == 0:
-        return JsonResponse({"authenticated": False, "product": dict(), "message": "Not authenticated."})
+        return FastJsonResponse({"authenticated": False, "product": dict(), "message": "Not authenticated."})
 
     data = json.loads(request.body)
     store, keyword = data.get("store").strip(), data.get("keyword").strip()
-    info = Product.search_product(store, keyword)
+    info = await Product.search_product_async(store, keyword)
     if info is None:
         info = dict()
         msg = "Invalid input."
@@ -88,13 +90,13 @@ def search_product(request):
         msg = ""
     else:
         msg = "Not found."
-    return JsonResponse({"authenticated": True, "product": info, "message": msg})
+    return FastJsonResponse({"authenticated": True, "product": info, "message": msg})
 
 
 def add_product(request):
     userid = get_userid(request)
     if userid == 0:
-        return JsonResponse({"authenticated": False, "message": "Not authenticated."})
+        return FastJsonResponse({"authenticated": False, "message": "Not authenticated."})
 
     data = json.loads(request.body)
     store, product = data.get("store"), data.get("product")
@@ -106,13 +108,13 @@ def add_product(request):
         msg = "Add succeeded."
     else:
         msg = "Add failed."
-    return JsonResponse({"authenticated": True, "message": msg})
+    return FastJsonResponse({"authenticated": True, "message": msg})
 
 
 def get_zipcode(request):
     userid = get_userid(request)
     if userid == 0:
-        return JsonResponse({"authenticated": False, "zipcode": "", "message": "Not authenticated."})
+        return FastJsonResponse({"authenticated": False, "zipcode": "", "message": "Not authenticated."})
 
     zipcode = ""
     msg = ""
@@ -121,22 +123,38 @@ def get_zipcode(request):
         msg = "Server error."
     elif info:
         zipcode = info[0][0]
-    return JsonResponse({"authenticated": True, "zipcode": zipcode, "message": msg})
+    return FastJsonResponse({"authenticated": True, "zipcode": zipcode, "message": msg})
 
 
-def list_all_inventory(request):
-    userid = get_userid(request)
+async def list_all_inventory(request):
+    userid = await sync_to_async(get_userid)(request)
     if userid == 0:
-        return JsonResponse({"authenticated": False, "stores": [], "message": "Not authenticated."})
+        return FastJsonResponse({"authenticated": False, "stores": [], "message": "Not authenticated."})
 
-    zipcode = json.loads(request.body).get("zipcode").strip()
+    data = json.loads(request.body)
+    zipcode = data.get("zipcode").strip()
     if not zipcode.strip().isdigit() or len(zipcode) != 5:
-        return JsonResponse({"authenticated": True, "stores": [], "message": "Invalid zipcode."})
-    Product.update_zipcode(userid, zipcode)
+        return FastJsonResponse({"authenticated": True, "stores": [], "message": "Invalid zipcode."})
+    await sync_to_async(Product.update_zipcode, thread_sensitive=False)(userid, zipcode)
 
+    # "swr": stale-while-revalidate, return current inventory at once and
+    # refresh stale products in background, poll while "refreshing" is True
+    revalidate = data.get("mode") == "swr"
     msg = ""
-    info = Product.list_all_inventory(userid, zipcode)
+    info = await Product.list_all_inventory_async(userid, zipcode, revalidate)
     if info is None:
         msg = "Server error."
-        info = []
-    return JsonResponse({"authenticated": True, "stores": info, "message": msg})
+        info = ("[]", [])
+    stores, missing = info
+    refreshing = revalidate and bool(missing)
+    return FastJsonResponse(
+        {"authenticated": True, "stores": RawJSON(stores), "refreshing": refreshing, "message": msg}
+    )
+
+
+def get_stats(request):
+    userid = get_userid(request)
+    if userid == 0:
+        return FastJsonResponse({"authenticated": False, "stats": dict(), "message": "Not authenticated."})
+
+    return FastJsonResponse({"authenticated": True, "stats": Product.get_stats(), "message": ""})
@@ -174,6 +174,20 @@ CELERY_TASK_TIME_LIMIT = 10 * 60
 # Disable prefetching.
 CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 
+# In-queue expiry of product tasks in seconds. Celery applies
+# numeric expiry relative to the time each message is sent, a
+# datetime computed at import time would expire every message
+# once the process has been up that long. Messages not started
+# in time are revoked by workers and counted as expired.
+PRODUCT_TASK_EXPIRES = {
+    "get_quantity_from_store": 60 * 60,
+    "add_quantity_to_db": 60 * 60,
+    "count_quantity": 5 * 60,
+    "count_get_add_quantity": 5 * 60,
+    "preload": 5 * 60,
+    "update_zipcode": 5 * 60,
+}
+
 # Run synchronously for testing and debugging.
 # CELERY_TASK_ALWAYS_EAGER = True
 
@@ -199,41 +213,103 @@ CELERY_RESULT_BACKEND = "redis://{}:{}@{}:{}/{}".format(
 # at 4am.
 CELERY_RESULT_EXPIRES = 12 * 60 * 60
 
-# Setup queues manually.
-# Not needed if CELERY_TASK_CREATE_MISSING_QUEUES
-# is True (by default).
-# celery -A shopping worker -l info -> [queues]: celery
-# celery -A shopping worker -l info -Q fast -> [queues]: fast
-# CELERY_TASK_QUEUES = {
-#     "fast": {
-#         "exchange": "fast",
-#         "routing_key": "fast",
-#     },
-#     "slow": {
-#         "exchange": "slow",
-#         "routing_key": "slow",
-#     },
-# }
-# When manual CELERY_TASK_QUEUES is set, things change.
-# celery -A shopping worker -l info
-#   -> [queues]: fast and slow
-# celery -A shopping worker -l info -Q fast
-#   -> [queues]: fast
+# Two lanes, one queue each: "interactive" for refreshes a user
+# is waiting on, "background" for preloads. Queues are consumed
+# independently, a worker of several queues takes from them in
+# turn, so the interactive lane gets workers of its own that a
+# backlog of background tasks cannot hold up, see
+# docker-compose.yml. Background workers also take interactive
+# tasks, in turn with background ones.
+# celery -A shopping worker -Q interactive -n interactive@%h
+# celery -A shopping worker -Q background,interactive -n background@%h
 CELERY_TASK_QUEUES = {
-    # The default queue for tasks is celery. Either keep
-    # it or set CELERY_TASK_DEFAULT_QUEUE = "fast"
-    "celery": {
-        "exchange": "celery",
-        "routing_key": "celery",
-    },
-    "fast": {
-        "exchange": "fast",
-        "routing_key": "fast",
+    "interactive": {
+        "exchange": "interactive",
+        "routing_key": "interactive",
     },
-    "slow": {
-        "exchange": "slow",
-        "routing_key": "slow",
+    "background": {
+        "exchange": "background",
+        "routing_key": "background",
     },
 }
-# celery -A shopping worker -l info
-#   -> [queues]: celery, fast and slow
+CELERY_TASK_DEFAULT_QUEUE = "background"
+PRODUCT_LANES = ("interactive", "background")
+
+# Inventory refresh.
+# Skip downloading quantity of a product when at least this
+# many stores around the zipcode have quantity checked within
+# 1 hour. Variation exists, not always 20 stores are returned.
+INVENTORY_FRESH_STORE_COUNT = 18
+# Maximum concurrent quantity and store downloads per process.
+INVENTORY_FETCH_WORKERS = int(os.environ.get("INVENTORY_FETCH_WORKERS", "4"))
+# Seconds to wait for quantity downloads per inventory request.
+# Products not downloaded by then are reported as stale, their
+# downloads keep running in background and are still saved.
+INVENTORY_FETCH_DEADLINE = float(os.environ.get("INVENTORY_FETCH_DEADLINE", "5"))
+
+# Seconds to cache list_all_inventory responses per user and
+# zipcode, aligned with the 1-hour quantity freshness window.
+# Entries are invalidated earlier when relevant rows change.
+INVENTORY_CACHE_TTL = int(os.environ.get("INVENTORY_CACHE_TTL", "3600"))
+
+# Identical quantity downloads, same (sku, store, zipcode), are
+# coalesced across threads and processes with a Redis lock. The
+# result is reused for this many seconds, and followers wait at
+# most this many seconds for the leader.
+QUANTITY_SINGLEFLIGHT_RESULT_TTL = int(os.environ.get("QUANTITY_SINGLEFLIGHT_RESULT_TTL", "5"))
+QUANTITY_SINGLEFLIGHT_WAIT = float(os.environ.get("QUANTITY_SINGLEFLIGHT_WAIT", "10"))
+# Seconds a background refresh of a product around a zipcode
+# is not enqueued again in stale-while-revalidate mode, and a
+# product just downloaded is no longer reported as refreshing
+# while fewer than INVENTORY_FRESH_STORE_COUNT stores have it.
+INVENTORY_REFRESH_LEASE = int(os.environ.get("INVENTORY_REFRESH_LEASE", "60"))
+# Seconds quantity of a product around a zipcode is not
+# downloaded again after the scraper confirmed that no store
+# nearby has it.
+INVENTORY_EMPTY_TTL = int(os.environ.get("INVENTORY_EMPTY_TTL", "300"))
+# SKUs unknown upstream are not downloaded until their entry,
+# recorded by the scraper in Redis, expires. They are checked
+# locally by a Bloom filter, hits are confirmed in Redis:
+# expected count, false positive rate and seconds between
+# checks for SKUs added by the scraper.
+INVALID_SKUS = {
+    "capacity": int(os.environ.get("INVALID_SKUS_CAPACITY", "100000")),
+    "error_rate": 0.001,
+    "check": 60,
+}
+# Seconds to wait for stores around a new zipcode to be looked
+# up. Concurrent lookups of the same (store, zipcode) are
+# coalesced across processes, followers wait as long.
+STORE_LOOKUP_DEADLINE = int(os.environ.get("STORE_LOOKUP_DEADLINE", "15"))
+# A new zipcode is mapped to known stores within this many miles
+# of its centroid, without upstream lookup, when at least as many
+# stores as one lookup returns are known.
+STORE_RADIUS_MILES = float(os.environ.get("STORE_RADIUS_MILES", "50"))
+STORE_NEARBY_COUNT = int(os.environ.get("STORE_NEARBY_COUNT", "20"))
+# Seconds between checks whether another process added stores,
+# so the in-process store index is reloaded.
+STORE_INDEX_CHECK = int(os.environ.get("STORE_INDEX_CHECK", "60"))
+# Seconds after a preload of a user during which page loads do
+# not trigger another preload.
+PRELOAD_DEBOUNCE = int(os.environ.get("PRELOAD_DEBOUNCE", "300"))
+# Stale products per scraper request when preloading.
+PRELOAD_BATCH_SIZE = int(os.environ.get("PRELOAD_BATCH_SIZE", "20"))
+# Preloads stream quantity from the scraper, one product per line
+# as its download completes, and save every this many rows while
+# the rest are still downloading. Seconds to wait for each line.
+PRELOAD_UPSERT_ROWS = int(os.environ.get("PRELOAD_UPSERT_ROWS", "100"))
+PRELOAD_LINE_TIMEOUT = float(os.environ.get("PRELOAD_LINE_TIMEOUT", "15"))
+
+# Token bucket for calls to the scraper, shared by web processes
+# and Celery workers through Redis: tokens per second and burst.
+# Tasks without a token are rescheduled instead of sleeping in a
+# worker slot, and given up after "reschedules" times. These do
+# not count as retries of failed tasks.
+SCRAPER_RATE_LIMIT = {
+    "rate": float(os.environ.get("SCRAPER_RATE", "5")),
+    "burst": int(os.environ.get("SCRAPER_BURST", "10")),
+    "reschedules": 20,
+}
+# Seconds a preload waits for a scraper token per batch before
+# leaving the remaining products to the next preload.
+PRELOAD_TOKEN_WAIT = float(os.environ.get("PRELOAD_TOKEN_WAIT", "10"))